@@ -8,7 +8,7 @@
 
 # Requirements:
 # - Linux / FreeBSD / Mac OS
-# - Python >= 2.5
+# - Python >= 2.6
 # - Java (http://www.java.com/en/download/manual.jsp)
 # - YUI Compressor (http://developer.yahoo.com/yui/compressor/)
 # - Google Closure Compiler (http://code.google.com/closure/compiler/)
@@ -20,410 +20,3178 @@ __version__ = '1.2.0'
 import os
 import re
 import sys
+import errno
+import random
+import platform
 import fcntl
+import socket
+import struct
+import zlib
+import mmap
+import select
+import ctypes
+import ctypes.util
+import glob
+import json
+import csv
 import hashlib
 import atexit
+import cProfile
+import pstats
 import logging
 import optparse
 import time
 import datetime
+import stat
 import shutil
+import sqlite3
 import tempfile
 import operator
 import subprocess
 import threading
+import itertools
+import multiprocessing
+import Queue
+import urlparse
+import SocketServer
+import BaseHTTPServer
 import cPickle as pickle
 
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
 # Path to the external tools / binaries
 JAVA_PATH = '/usr/local/bin/java'
 YUI_COMPRESSOR_PATH = '/usr/local/bin/yuicompressor.jar'
 CLOSURE_COMPILER_PATH = '/usr/local/bin/closure-compiler.jar'
 JPEGOPTIM_PATH = '/usr/local/bin/jpegoptim'
 OPTIPNG_PATH = '/usr/local/bin/optipng'
+GIFSICLE_PATH = '/usr/local/bin/gifsicle'
 
-class AssetDeflator():
-	javascript_re = re.compile(r'<script\s*(?:type=["\']?text/javascript["\']?)?>(.*?)</script>', re.DOTALL | re.IGNORECASE)
-	css_re = re.compile(r'<style\s*(?:type=["\']?text/css["\']?)?>(.*?)</style>', re.DOTALL | re.IGNORECASE)
-	file_name_suffix = '.min'
+# Path to git - if the assets path is inside a git work tree, the files are compared by their git blob IDs
+GIT_PATH = '/usr/bin/git'
+
+# Path to the Nailgun server jar (http://www.martiansoftware.com/nailgun/) - if it exists, YUI compressor
+# and Closure compiler are run inside a pool of long-lived JVMs instead of starting a new JVM for every file
+NAILGUN_PATH = '/usr/local/bin/nailgun.jar'
+
+# Arguments which are passed to the tools
+YUI_COMPRESSOR_CSS_ARGS = ['--type', 'css']
+CLOSURE_COMPILER_ARGS = ['--compilation_level', 'SIMPLE_OPTIMIZATIONS', '--warning_level', 'QUIET']
+JPEGOPTIM_ARGS = ['--strip-all']
+OPTIPNG_ARGS = []
+GIFSICLE_ARGS = []
+
+# Arguments used by the refine pass (--refine), which works on the files again with the slow settings and keeps the
+# outputs which are smaller. JavaScript files are only refined with --refine-advanced-js, there are no slower Closure
+# compiler settings which keep the scripts working the same (ADVANCED_OPTIMIZATIONS renames the symbols which are not
+# exported, which breaks the scripts using each other's globals)
+CLOSURE_COMPILER_REFINE_ARGS = ['--compilation_level', 'ADVANCED_OPTIMIZATIONS', '--warning_level', 'QUIET']
+JPEGOPTIM_REFINE_ARGS = ['--all-progressive']
+OPTIPNG_REFINE_ARGS = ['-o7']
+GIFSICLE_REFINE_ARGS = ['-O3']
+
+# CSS files and inline code blocks up to this size (in bytes) are minified with the built-in Python minifier
+# instead of YUI compressor (0 disables the built-in minifier)
+PYTHON_CSS_MINIFIER_THRESHOLD = 2048
+
+# Optimization tiers reached by the files (recorded in the state) - outputs of a regular run and refined outputs
+TIER_FAST = 1
+TIER_REFINED = 2
+
+# Files whose content hasn't changed and whose last run saved less than this (percent of the file size) are not
+# worked on again (0 disables it)
+MIN_SAVINGS = 1.0
+
+# Throughput (bytes per second) assumed for the jobs of an action when the duration isn't known for any of its files
+DEFAULT_THROUGHPUT = 256 * 1024
+
+# Number of the content hash characters in the fingerprinted output file names (foo.3f9a1c.min.css)
+FINGERPRINT_LENGTH = 6
+
+# Size of the chunks in which the large files are read, copied and compressed
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Maximum heap size (MB) of the JVMs which run YUI compressor and Closure compiler
+JAVA_HEAP_SIZE = 256
+
+# Memory (MB) needed by a JVM on top of its heap, memory (MB) needed by a job which doesn't start a JVM and memory
+# (MB) kept free when the number of jobs worked on at once is adapted to the available memory
+JAVA_OVERHEAD = 64
+TOOL_MEMORY = 32
+MEMORY_RESERVE = 256
+
+# Extensions of the files each of the actions works on
+FILE_EXTENSIONS = {
+	'css': ['css'],
+	'js': ['js'],
+	'tpl': ['htm', 'html', 'tpl', 'php', 'asp'],
+	'img': ['jpg', 'jpeg', 'png', 'gif']
+}
+
+JAVA_MAIN_CLASSES = {
+	'yui': 'com.yahoo.platform.yui.compressor.YUICompressor',
+	'closure': 'com.google.javascript.jscomp.CommandLineRunner'
+}
+
+class ToolProcess(subprocess.Popen):
+	"""
+	Popen which records the resource usage (rusage) of the finished process, it is collected with os.wait4.
+	
+	Running tool processes are tracked, so their resident memory can be sampled.
+	"""
 	
-	event = threading.Event()
+	rusage = None
+	running = set()
 	lock = threading.Lock()
-	inline_running = False
-	inline_run_count = 0
 	
-	def __init__(self, assets_path, actions, overwrite_original, print_statistics, save_state_file = None, \
-				state_file = None, lock_file = '/tmp/asset_deflator.lock'):
-		self.assets_path = assets_path
-		self.actions = actions
-		self.overwrite_original = overwrite_original
-		self.print_statistics = print_statistics
-		self.save_state_file = save_state_file
-		self.state_file = state_file
+	def __init__(self, *args, **kwargs):
+		subprocess.Popen.__init__(self, *args, **kwargs)
 		
-		self.input_files = []
+		with ToolProcess.lock:
+			ToolProcess.running.add(self.pid)
+	
+	@classmethod
+	def get_resident_memory(cls):
+		""" Return the total resident memory (in bytes) of the running tool processes (0 if /proc is not available). """
 		
-		(file_name, file_extension) = os.path.splitext(lock_file)
-		self.lock_file = file_name + '.'  + hashlib.md5(self.assets_path).hexdigest() + file_extension
+		with cls.lock:
+			pids = list(cls.running)
+		
+		total = 0
+		for pid in pids:
+			try:
+				with open('/proc/%d/statm' % (pid), 'r') as file:
+					total += int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+			except (IOError, ValueError, IndexError):
+				pass
+			
+		return total
+	
+	def wait(self):
+		while self.returncode is None:
+			try:
+				(pid, status, self.rusage) = os.wait4(self.pid, 0)
+			except OSError, e:
+				if e.errno == errno.EINTR:
+					continue
+				elif e.errno != errno.ECHILD:
+					raise
+				
+				# Process was already reaped
+				(pid, status) = (self.pid, 0)
+				
+			if pid == self.pid:
+				self._handle_exitstatus(status)
+		
+		with ToolProcess.lock:
+			ToolProcess.running.discard(self.pid)
+				
+		return self.returncode
 
-		self.files_count = 0
-		self.size_before = {'css': 0, 'js': 0, 'tpl': 0, 'img': 0}
-		self.size_after = {'css': 0, 'js': 0, 'tpl': 0, 'img': 0}
+class ToolError(Exception):
+	""" Raised when a tool exits with a non-zero status. """
+	
+	def __init__(self, tool, status):
+		Exception.__init__(self, '%s exited with status %d' % (tool, status))
+		self.tool = tool
+		self.status = status
+
+class StateFileError(Exception):
+	""" Raised instead of exiting when the state file can't be used in the server mode (the request fails). """
+
+class JavaWorkerPool():
+	"""
+	A pool of long-lived JVMs (Nailgun servers) which have YUI compressor and Closure compiler
+	on the class path.
+	
+	Each JVM runs a single command at once, the commands are sent to the JVM over a local socket
+	using the Nailgun protocol.
+	"""
+	
+	def __init__(self, size, class_path, heap_size = JAVA_HEAP_SIZE, start_timeout = 30):
+		self.size = size
+		self.class_path = class_path
+		self.heap_size = heap_size
+		self.start_timeout = start_timeout
+		
+		self.processes = []
+		self.free_ports = Queue.Queue()
+		self.launches_avoided = 0
+		self.lock = threading.Lock()
 		
 	def start(self):
-		""" Start the minification / compilation / compression process. """
+		""" Start the JVMs and wait for them to accept connections. Returns True on success, False otherwise. """
 		
-		# Only one instance can work on the same path at once
+		ports = []
+		with open(os.devnull, 'w') as devnull:
+			for index in range(self.size):
+				port = self.__find_free_port()
+				try:
+					process = ToolProcess([JAVA_PATH, '-Xmx%dm' % (self.heap_size), '-cp', ':'.join(self.class_path), 'com.martiansoftware.nailgun.NGServer', \
+										'127.0.0.1:%d' % (port)], stdout = devnull, stderr = devnull, close_fds = True)
+				except OSError, e:
+					logging.error('Java worker pool: failed to start a JVM (%(error)s)' % {'error': e})
+					self.stop()
+					return False
+				
+				self.processes.append(process)
+				ports.append(port)
+		
+		deadline = time.time() + self.start_timeout
+		for process, port in zip(self.processes, ports):
+			while not self.__is_listening(port):
+				if process.poll() is not None or time.time() > deadline:
+					logging.error('Java worker pool: JVM on port %(port)d did not start' % {'port': port})
+					self.stop()
+					return False
+					
+				time.sleep(0.1)
+			
+			self.free_ports.put(port)
+		
+		logging.info('Java worker pool: started %(count)d JVMs' % {'count': self.size})
+		return True
+		
+	def stop(self):
+		""" Stop all the JVMs. """
+		
+		for process in self.processes:
+			if process.poll() is None:
+				process.terminate()
+				process.wait()
+				
+		self.processes = []
+	
+	def run(self, main_class, args, input_data = None):
+		"""
+		Run the main class with the provided arguments in one of the JVMs and return
+		a (exit_code, output) tuple.
+		"""
+		
+		port = self.free_ports.get()
 		try:
-			self.__lock()
-		except IOError:
-			print 'Another instance of Asset Deflator is already running - exiting.'
-			sys.exit(1)
+			result = self.__nailgun_call(port, main_class, args, input_data)
+		finally:
+			self.free_ports.put(port)
+			
+		with self.lock:
+			self.launches_avoided += 1
+			
+		return result
 		
-		self.__create_temporary_directories()
-		atexit.register(self.__delete_lock_file)
-		atexit.register(self.__cleanup_tempporary_files)
+	def __nailgun_call(self, port, main_class, args, input_data):
+		""" Send a command to the Nailgun server listening on the provided port and read the result. """
 		
-		actions = {
-				'minify_css': {'action': 'minify_css', 'args': None, 'input_files': None},
-				'minify_inline_css': {'action': 'compress_inline_code', 'args': 'css', 'input_files': None},
-				'compile_js': {'action': 'compile_javascript', 'args': None, 'input_files': None},
-				'compile_inline_js': {'action': 'compress_inline_code', 'args': 'js', 'input_files': None},
-				'compress_imgs': {'action': 'compress_images', 'args': None, 'input_files': None}
-		}
+		connection = socket.create_connection(('127.0.0.1', port))
+		try:
+			for arg in args:
+				self.__send_chunk(connection, 'A', arg)
+				
+			self.__send_chunk(connection, 'D', os.getcwd())
+			self.__send_chunk(connection, 'C', main_class)
+			
+			if input_data:
+				self.__send_chunk(connection, '0', input_data)
+			self.__send_chunk(connection, '.', '')
+			
+			output = []
+			while True:
+				(chunk_type, payload) = self.__read_chunk(connection)
+				
+				if chunk_type == '1':
+					output.append(payload)
+				elif chunk_type == 'X':
+					return (int(payload.strip()), ''.join(output))
+		finally:
+			connection.close()
+			
+	def __send_chunk(self, connection, chunk_type, payload):
+		connection.sendall(struct.pack('>ic', len(payload), chunk_type) + payload)
 		
-		for key in self.actions.keys():
-			if key == 'minify_css':
-				actions[key]['input_files'] = ()
-				actions[key]['input_files'] = self.__find_valid_files(self.assets_path, ['css'])
-			elif key == 'minify_inline_css':
-				actions[key]['input_files'] = self.__find_files_with_inline_code(self.css_re, self.__find_valid_files(self.assets_path, ['htm', 'html', 'tpl', 'php', 'asp']))
-			elif key == 'compile_js':
-				actions[key]['input_files'] = self.__find_valid_files(self.assets_path, ['js'])
-			elif key == 'compile_inline_js':
-				actions[key]['input_files'] = self.__find_files_with_inline_code(self.javascript_re, self.__find_valid_files(self.assets_path, ['htm', 'html', 'tpl', 'php', 'asp']))
-			elif key == 'compress_imgs':
-				actions[key]['input_files'] = self.__find_valid_files(self.assets_path, ['jpg', 'jpeg', 'png', 'gif'])
+	def __read_chunk(self, connection):
+		(length, chunk_type) = struct.unpack('>ic', self.__read_bytes(connection, 5))
+		return (chunk_type, self.__read_bytes(connection, length))
+		
+	def __read_bytes(self, connection, count):
+		data = []
+		while count > 0:
+			buffer = connection.recv(count)
+			if not buffer:
+				raise socket.error('Nailgun server closed the connection')
+			
+			data.append(buffer)
+			count -= len(buffer)
+			
+		return ''.join(data)
+		
+	def __find_free_port(self):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.bind(('127.0.0.1', 0))
+		port = sock.getsockname()[1]
+		sock.close()
+		
+		return port
+		
+	def __is_listening(self, port):
+		try:
+			socket.create_connection(('127.0.0.1', port), 1).close()
+		except socket.error:
+			return False
+		
+		return True
+
+class OutputCache():
+	"""
+	Content addressed on-disk cache of the tool outputs.
+	
+	Entries are keyed by the input content hash, the tool, the tool version and the tool arguments.
+	Entries are written atomically, so the cache directory can be shared by multiple machines, and
+	the least recently used entries are evicted once the cache grows over the size limit.
+	"""
+	
+	def __init__(self, directory, max_size, hard_link = False):
+		self.directory = directory
+		self.max_size = max_size
+		self.hard_link = hard_link
+		
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+		
+		# Temporary files are created with 0600 mode, outputs and cache entries get the default mode instead
+		umask = os.umask(0)
+		os.umask(umask)
+		self.file_mode = 0666 & ~umask
+		
+	def get_key(self, input_hash, tool, tool_version, args):
+		""" Return the cache key for the provided input hash, tool, tool version and tool arguments. """
+		
+		return hashlib.sha1('\0'.join([input_hash, tool, tool_version] + list(args))).hexdigest()
+		
+	def get(self, key, output_file):
+		""" Copy (or hard-link) the cached output to output_file. Returns True on a cache hit, False otherwise. """
+		
+		entry_path = self.__get_entry_path(key)
+		if not os.path.exists(entry_path):
+			self.__count(False)
+			return False
+		
+		(fd, temp_file) = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(output_file)), prefix = '.asset_deflator')
+		os.close(fd)
+		try:
+			if self.hard_link:
+				os.remove(temp_file)
+				os.link(entry_path, temp_file)
+			else:
+				shutil.copyfile(entry_path, temp_file)
+				os.chmod(temp_file, self.file_mode)
+				
+			os.rename(temp_file, output_file)
+			os.utime(entry_path, None)
+		except (IOError, OSError):
+			# Entry was evicted in the mean time
+			if os.path.exists(temp_file):
+				os.remove(temp_file)
+				
+			self.__count(False)
+			return False
+		
+		self.__count(True)
+		return True
+		
+	def contains(self, key):
+		""" Returns True if the entry is in the cache, False otherwise. """
+		
+		try:
+			os.utime(self.__get_entry_path(key), None)
+		except OSError:
+			return False
+		
+		return True
+		
+	def get_data(self, key):
+		""" Return the cached output or None if the output is not cached. """
+		
+		entry_path = self.__get_entry_path(key)
+		try:
+			with open(entry_path, 'rb') as file:
+				data = file.read()
+			os.utime(entry_path, None)
+		except (IOError, OSError):
+			self.__count(False)
+			return None
+		
+		self.__count(True)
+		return data
+	
+	def put(self, key, output_file):
+		""" Store the output file in the cache. """
+		
+		self.__store(key, lambda temp_file: shutil.copyfile(output_file, temp_file))
+		
+	def put_data(self, key, data):
+		""" Store the output in the cache. """
+		
+		def write(temp_file):
+			with open(temp_file, 'wb') as file:
+				file.write(data)
+				
+		self.__store(key, write)
+		
+	def evict(self):
+		""" Delete the least recently used entries until the cache size is below the size limit. """
+		
+		entries = []
+		total_size = 0
+		for dir_path, dir_names, file_names in os.walk(self.directory):
+			for file in file_names:
+				file_path = os.path.join(dir_path, file)
+				try:
+					stat = os.stat(file_path)
+				except OSError:
+					continue
+				
+				entries.append((stat.st_mtime, stat.st_size, file_path))
+				total_size += stat.st_size
+		
+		entries.sort()
+		for mtime, size, file_path in entries:
+			if total_size <= self.max_size:
+				break
+			
+			try:
+				os.remove(file_path)
+			except OSError:
+				pass
+			
+			total_size -= size
+	
+	def __store(self, key, write):
+		entry_path = self.__get_entry_path(key)
+		try:
+			if not os.path.isdir(os.path.dirname(entry_path)):
+				os.makedirs(os.path.dirname(entry_path))
+		except OSError:
+			# Directory was created by another process in the mean time
+			pass
+		
+		(fd, temp_file) = tempfile.mkstemp(dir = os.path.dirname(entry_path), prefix = '.tmp')
+		os.close(fd)
+		try:
+			write(temp_file)
+			os.chmod(temp_file, self.file_mode)
+			os.rename(temp_file, entry_path)
+		except (IOError, OSError), e:
+			logging.error('Output cache: failed to store %(key)s (%(error)s)' % {'key': key, 'error': e})
+			if os.path.exists(temp_file):
+				os.remove(temp_file)
+	
+	def __get_entry_path(self, key):
+		return os.path.join(self.directory, key[:2], key)
+		
+	def __count(self, hit):
+		with self.lock:
+			if hit:
+				self.hits += 1
+			else:
+				self.misses += 1
+
+class ResultCache():
+	"""
+	Bounded in-memory cache of the results (minified code) keyed by the content hash.
+	
+	When the cache grows over the maximum size (in bytes), the least recently used results are dropped
+	until it is down to 3/4 of the maximum size.
+	"""
+	
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.size = 0
+		self.entries = {}
+		self.counter = itertools.count()
+		self.lock = threading.Lock()
+		
+		self.hits = 0
+		self.misses = 0
+		
+	def get(self, key):
+		""" Return the cached result or None if there is no result for the key. """
+		
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+			
+			self.hits += 1
+			self.entries[key] = (entry[0], self.counter.next())
+			
+			return entry[0]
 		
-		if self.state_file:
-			# State file is provided, read the file list and skip the files which weren't modified
-			files = self.__read_state_file()
+	def put(self, key, result):
+		with self.lock:
+			if key in self.entries:
+				self.size -= len(self.entries[key][0])
+				
+			self.entries[key] = (result, self.counter.next())
+			self.size += len(result)
 			
-			if files:
-				# If the state file is not empty	
-				for key in actions.keys():
+			if self.size > self.max_size:
+				for (key, (result, last_used)) in sorted(self.entries.items(), key = lambda item: item[1][1]):
+					if self.size <= self.max_size * 3 / 4:
+						break
 					
-					input_files = actions[key]['input_files']
-					if input_files != None:
-						actions[key]['input_files'] = [f for f in input_files if os.path.getmtime(f) != files.get(f, '')]
+					del self.entries[key]
+					self.size -= len(result)
 
-		self.start_time = time.time()
-		workers = []
-		for key in self.actions.keys():
-			action = getattr(self, actions[key]['action'])
-			args = actions[key]['args']
-			files = actions[key]['input_files']
+class AdmissionController():
+	"""
+	Adapts the number of jobs worked on at once to the CPU cores and the memory.
+	
+	The limit starts at the number of jobs which fit in the available memory (less the reserve), capped by the
+	maximum number of jobs (the number of cores by default). The memory is sampled while the jobs run - the limit
+	is lowered when the available memory falls under the reserve and raised again when another job fits and the
+	cores are not busy. Every change of the limit is logged with its reason.
+	
+	Available memory is the lower of the cgroup memory limit less the cgroup usage (without the inactive page cache)
+	and MemAvailable from /proc/meminfo.
+	"""
+	
+	def __init__(self, max_jobs, job_memory, reserve, interval = 1.0):
+		self.max_jobs = max_jobs
+		self.job_memory = job_memory
+		self.reserve = reserve
+		self.interval = interval
+		
+		self.running = 0
+		self.sampled = time.time()
+		self.changes = []
+		self.condition = threading.Condition()
+		
+		self.limit = max_jobs
+		available = self.get_available_memory()
+		if available is not None and max(0, available - reserve) / job_memory < max_jobs:
+			count = max(0, available - reserve) / job_memory
+			with self.condition:
+				self.__set_limit(max(1, count), 'available memory %(available)d MB (less %(reserve)d MB reserve) fits %(count)d jobs of %(job)d MB' % \
+								{'available': available / 1024 / 1024, 'reserve': reserve / 1024 / 1024, 'count': count, 'job': job_memory / 1024 / 1024})
+		
+	def acquire(self):
+		""" Wait until another job can be worked on. """
+		
+		with self.condition:
+			self.__sample()
+			while self.running >= self.limit:
+				self.condition.wait(self.interval)
+				self.__sample()
+				
+			self.running += 1
+	
+	def release(self):
+		""" Release the job slot reserved by acquire. """
+		
+		with self.condition:
+			self.running -= 1
+			self.condition.notify_all()
 			
-			if files is not None:
-				if args:
-					workers.append(threading.Thread(target = action, args = (files, args)))
-				else:
-					workers.append(threading.Thread(target = action, args = (files,)))
+	def get_available_memory(self):
+		""" Return the memory (in bytes) available to the process or None if it's not known. """
+		
+		values = []
+		for (limit_file, usage_file, stat_file, inactive_key) in [
+				('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current', '/sys/fs/cgroup/memory.stat', 'inactive_file'),
+				('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes', '/sys/fs/cgroup/memory/memory.stat', 'total_inactive_file')]:
+			try:
+				with open(limit_file, 'r') as file:
+					limit = file.read().strip()
+				with open(usage_file, 'r') as file:
+					usage = int(file.read())
+				with open(stat_file, 'r') as file:
+					stats = dict([line.split() for line in file if len(line.split()) == 2])
+			except (IOError, ValueError):
+				continue
+			
+			# Unlimited cgroups have the limit set to 'max' (cgroup v2) or to a huge number (cgroup v1)
+			if limit.isdigit() and int(limit) < 1 << 60:
+				values.append(int(limit) - usage + int(stats.get(inactive_key, 0)))
+			break
+		
+		try:
+			with open('/proc/meminfo', 'r') as file:
+				for line in file:
+					if line.startswith('MemAvailable:'):
+						values.append(int(line.split()[1]) * 1024)
+		except (IOError, ValueError):
+			pass
+		
+		return min(values) if values else None
+	
+	def __sample(self):
+		""" Sample the memory (at most once per interval) and lower or raise the limit. """
+		
+		if time.time() - self.sampled < self.interval:
+			return
+		
+		self.sampled = time.time()
+		available = self.get_available_memory()
+		if available is None:
+			return
+		
+		values = {'available': available / 1024 / 1024, 'reserve': self.reserve / 1024 / 1024, 'tools': ToolProcess.get_resident_memory() / 1024 / 1024}
+		if available < self.reserve and self.limit > 1:
+			self.__set_limit(max(1, min(self.limit, self.running) - 1), \
+							'available memory %(available)d MB is under the %(reserve)d MB reserve (tool processes use %(tools)d MB)' % values)
+		elif available - self.reserve >= self.job_memory and self.limit < self.max_jobs:
+			values['load'] = os.getloadavg()[0]
+			if values['load'] < multiprocessing.cpu_count():
+				self.__set_limit(self.limit + 1, 'available memory %(available)d MB fits another job and the load is %(load).1f (tool processes use %(tools)d MB)' % values)
+	
+	def __set_limit(self, limit, reason):
+		level = logging.WARNING if limit < self.limit else logging.INFO
+		logging.log(level, 'Concurrency: %(old)d -> %(new)d jobs at once, %(reason)s' % {'old': self.limit, 'new': limit, 'reason': reason})
+		
+		self.changes.append({'time': time.time(), 'limit': limit, 'reason': reason})
+		self.limit = limit
+		self.condition.notify_all()
+
+class MemoryBudget():
+	"""
+	Limits the total size (in bytes) of the jobs which are worked on at once.
+	
+	A job waits until the running jobs have released enough of the budget, a job larger than the whole
+	budget waits until it can run alone.
+	"""
+	
+	def __init__(self, size):
+		self.size = size
+		self.used = 0
+		self.condition = threading.Condition()
+		
+	def acquire(self, size):
+		""" Wait until the job of the given size fits in the budget and return the reserved size. """
+		
+		size = min(size, self.size)
+		with self.condition:
+			while self.used + size > self.size:
+				self.condition.wait()
+				
+			self.used += size
+			
+		return size
+	
+	def release(self, size):
+		""" Release the size reserved by acquire. """
+		
+		with self.condition:
+			self.used -= size
+			self.condition.notify_all()
+
+class MappedFile():
+	"""
+	Read-only memory map of a file, used as a context manager.
+	
+	Regular expressions search the mapped content directly and only the slices which are needed are copied,
+	so large templates are never read to memory as a whole (an empty file, which can't be mapped, is an
+	empty string).
+	"""
+	
+	def __init__(self, path):
+		self.path = path
+		self.file = None
+		self.content = None
+		
+	def __enter__(self):
+		self.file = open(self.path, 'rb')
+		try:
+			if os.fstat(self.file.fileno()).st_size == 0:
+				self.content = ''
+			else:
+				self.content = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+		except:
+			self.file.close()
+			raise
+		
+		return self.content
+	
+	def __exit__(self, type, value, traceback):
+		if isinstance(self.content, mmap.mmap):
+			self.content.close()
+			
+		self.file.close()
+
+class JobScheduler():
+	"""
+	A global job queue shared by all the actions.
+	
+	Jobs are worked on by a fixed number of worker threads and the jobs with the largest cost (predicted
+	duration) are scheduled first.
+	"""
+	
+	def __init__(self, workers, profile = False):
+		self.workers = workers
+		self.profile = profile
+		self.queue = Queue.PriorityQueue()
+		self.counter = itertools.count()
+		self.threads = []
+		self.profiles = []
+		
+	def start(self):
+		""" Start the worker threads. """
+		
+		for index in range(self.workers):
+			thread = threading.Thread(target = self.__work)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+			
+	def stop(self):
+		""" Stop the worker threads once all the queued jobs are done. """
+		
+		for thread in self.threads:
+			self.queue.put((sys.maxint, self.counter.next(), None, None, None))
+			
+		for thread in self.threads:
+			thread.join()
+			
+		self.threads = []
+		
+	def run_batch(self, jobs):
+		"""
+		Queue a batch of (cost, function, args) jobs and wait for all of them to finish.
+		Returns a list with the job results (None for the jobs which have failed).
+		"""
+		
+		batch = {'pending': len(jobs), 'results': [None] * len(jobs), 'condition': threading.Condition()}
+		for index, (cost, function, args) in enumerate(jobs):
+			self.queue.put((-cost, self.counter.next(), function, args, (batch, index)))
+			
+		with batch['condition']:
+			while batch['pending'] > 0:
+				batch['condition'].wait()
+				
+		return batch['results']
+			
+	def __work(self):
+		# Every worker thread has its own profiler, the profiles are merged when they are saved
+		if self.profile:
+			profiler = cProfile.Profile()
+			profiler.enable()
+			
+		while True:
+			(priority, count, function, args, job) = self.queue.get()
+			if function is None:
+				break
+
+			(batch, index) = job
+			try:
+				batch['results'][index] = function(*args)
+			except Exception:
+				logging.exception('Job %(function)s%(args)r failed' % {'function': function.__name__, 'args': args})
+			finally:
+				with batch['condition']:
+					batch['pending'] -= 1
+					batch['condition'].notify_all()
 					
-		for worker in workers:
-			worker.start()
+		if self.profile:
+			profiler.disable()
+			self.profiles.append(profiler)
+
+class AssetIndex():
+	"""
+	Index of the asset files, built with a single walk over the assets path and shared by all the actions.
+	
+	Files are bucketed by extension and the size, modification time and the types of inline code found in
+	the file (templates only) are recorded for every file. The index can be saved to a file and loaded on
+	the next run - directories with unchanged modification time are not listed again and templates with
+	unchanged size and modification time are not searched for inline code again.
+	"""
+	
+	def __init__(self, path, file_name_suffix, inline_code_res, excluded_files = ()):
+		self.path = path
+		self.file_name_suffix = file_name_suffix
+		self.inline_code_res = inline_code_res
+		self.excluded_files = set(excluded_files)
+		self.extensions = set(sum(FILE_EXTENSIONS.values(), []))
+		
+		self.directories = {}
+		self.files = {}
+		
+	def load(self, index_file):
+		""" Load the index saved on the previous run. """
+		
+		try:
+			with open(index_file, 'rb') as file:
+				index = pickle.load(file)
+		except IOError:
+			return
+		except Exception, e:
+			logging.error('Index file %(index_file)s is corrupted, the assets path will be scanned again (%(error)s)' % {'index_file': index_file, 'error': e})
+			return
+		
+		if index.get('path') == self.path:
+			self.directories = index['directories']
+			self.files = index['files']
+		
+	def save(self, index_file):
+		""" Save the index to a file. """
+		
+		with open(index_file, 'wb') as file:
+			pickle.dump({'path': self.path, 'directories': self.directories, 'files': self.files}, file, pickle.HIGHEST_PROTOCOL)
+	
+	def scan(self):
+		""" Walk the assets path, update the index and return a list of new and modified files. """
+		
+		directories = {}
+		files = {}
+		changed_files = []
+		
+		pending = [self.path]
+		while pending:
+			dir_path = pending.pop()
+			try:
+				mtime = os.stat(dir_path).st_mtime
+			except OSError:
+				continue
+			
+			directory = self.directories.get(dir_path)
+			if not directory or directory['mtime'] != mtime:
+				directory = self.__list_directory(dir_path, mtime)
+				
+			directories[dir_path] = directory
+			pending.extend([os.path.join(dir_path, dir_name) for dir_name in directory['directories']])
+			
+			for file in directory['files']:
+				file_path = os.path.join(dir_path, file)
+				entry = self.__get_entry(file_path)
+				
+				if entry:
+					if entry is not self.files.get(file_path):
+						changed_files.append(file_path)
+						
+					files[file_path] = entry
+		
+		self.directories = directories
+		self.files = files
+		
+		return changed_files
+	
+	def update_file(self, file_path):
+		""" Update the index entry of a single file and return it (None if the file doesn't exist or it's not an asset file). """
+		
+		entry = self.__get_entry(file_path)
+		if entry:
+			self.files[file_path] = entry
+		elif file_path in self.files:
+			del self.files[file_path]
+		
+		return entry
+		
+	def get_files(self, extensions):
+		""" Return a list of files with one of the provided extensions. """
+		
+		return [file for file, entry in self.files.iteritems() if entry['extension'] in extensions]
+	
+	def get_files_with_inline_code(self, type):
+		""" Return a list of templates which contain the provided type ('css' or 'js') of inline code. """
+		
+		return [file for file, entry in self.files.iteritems() if entry['inline_code'] and type in entry['inline_code']]
+	
+	def __get_entry(self, file_path):
+		""" Return the (existing, if the file hasn't changed) index entry for the file or None if it's not an asset file. """
+		
+		file = os.path.basename(file_path)
+		extension = file.split('.')[-1]
+		
+		# Skip the files with .min suffix so we don't do stuff with already minified / compressed files
+		if extension not in self.extensions or file.find(self.file_name_suffix) != -1 or file_path in self.excluded_files:
+			return None
+		
+		try:
+			stat = os.stat(file_path)
+		except OSError:
+			return None
+		
+		entry = self.files.get(file_path)
+		if not entry or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+			entry = {'extension': extension, 'size': stat.st_size, 'mtime': stat.st_mtime, 'inline_code': None}
+			
+			if extension in FILE_EXTENSIONS['tpl']:
+				entry['inline_code'] = self.__find_inline_code(file_path)
+				
+		return entry
+	
+	def __list_directory(self, dir_path, mtime):
+		directory = {'mtime': mtime, 'files': [], 'directories': []}
 		
-		# Wait for all the threads to finish		
-		for thread in threading.enumerate():
-			if thread is not threading.currentThread():
-				thread.join()
+		try:
+			names = os.listdir(dir_path)
+		except OSError:
+			return directory
+		
+		for name in names:
+			path = os.path.join(dir_path, name)
+			
+			# Symbolic links to directories are not followed (same as os.walk)
+			if os.path.isdir(path):
+				if not os.path.islink(path):
+					directory['directories'].append(name)
+			else:
+				directory['files'].append(name)
+				
+		return directory
+	
+	def __find_inline_code(self, file_path):
+		""" Return a tuple with the types of inline code found in the file. """
+		
+		try:
+			with MappedFile(file_path) as content:
+				return tuple([type for type, regular_expression in sorted(self.inline_code_res.items()) if regular_expression.search(content)])
+		except EnvironmentError:
+			return ()
+
+class BuildDatabase():
+	"""
+	State of the files worked on by the previous runs, stored in a SQLite database with a row per file
+	(path, size, modification time, content hash, output hash, tool version, optimization tier, savings ratio,
+	duration of the last run and git blob ID) indexed by the path.
+	
+	Rows are looked up one by one and only the rows of the files worked on by the current run are written.
+	A state file saved by an older version (pickled dictionary file path: modification time) is converted
+	when it is opened, corrupted state files raise sqlite3.DatabaseError.
+	"""
+	
+	def __init__(self, path):
+		self.path = path
+		
+		if os.path.exists(path) and not self.__is_database_file(path):
+			self.__convert_legacy_file()
+		
+		self.connection = sqlite3.connect(path)
+		self.connection.row_factory = sqlite3.Row
+		self.connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, ' \
+								'content_hash TEXT, output_hash TEXT, tool_version TEXT, tier INTEGER, savings REAL, duration REAL, ' \
+								'blob_id TEXT)')
+		
+		# Databases saved by the previous versions don't have all the columns
+		columns = [column[1] for column in self.connection.execute('PRAGMA table_info(files)')]
+		for (name, type) in [('tier', 'INTEGER'), ('savings', 'REAL'), ('duration', 'REAL'), ('blob_id', 'TEXT')]:
+			if name not in columns:
+				self.connection.execute('ALTER TABLE files ADD COLUMN %s %s' % (name, type))
+			
+		self.connection.commit()
+		
+	def get(self, path):
+		""" Return the row for the file or None if the file wasn't worked on before. """
+		
+		return self.connection.execute('SELECT * FROM files WHERE path = ?', (path,)).fetchone()
+	
+	def update(self, rows):
+		"""
+		Insert or replace the rows (path, size, mtime, content_hash, output_hash, tool_version, tier, savings, duration,
+		blob_id) in a single transaction.
+		"""
+		
+		with self.connection:
+			self.connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+			
+	def merge(self, path):
+		""" Copy all the rows from another build database. """
+		
+		self.connection.execute('ATTACH DATABASE ? AS source', (path,))
+		try:
+			with self.connection:
+				self.connection.execute('INSERT OR REPLACE INTO files SELECT * FROM source.files')
+		finally:
+			self.connection.execute('DETACH DATABASE source')
+			
+	def close(self):
+		self.connection.close()
+			
+	def __is_database_file(self, path):
+		with open(path, 'rb') as file:
+			header = file.read(16)
+			
+		return not header or header == 'SQLite format 3\0'
+	
+	def __convert_legacy_file(self):
+		""" Convert the pickled state file to a build database (bundle rows hold the bundle signature as the content hash). """
+		
+		try:
+			with open(self.path, 'rb') as file:
+				state = pickle.load(file)
+		except Exception, e:
+			raise sqlite3.DatabaseError('%(path)s: file is not a database nor a legacy state file (%(error)s)' % {'path': self.path, 'error': e})
+		
+		rows = []
+		for (path, value) in state.iteritems():
+			if isinstance(value, basestring):
+				rows.append((path, None, None, value, None, None, None, None, None, None))
+			else:
+				rows.append((path, None, value, None, None, None, None, None, None, None))
+		
+		(fd, temp_path) = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(self.path)))
+		os.close(fd)
+		
+		database = BuildDatabase(temp_path)
+		database.update(rows)
+		database.connection.close()
+		
+		os.chmod(temp_path, os.stat(self.path).st_mode & 0777)
+		os.rename(temp_path, self.path)
+		logging.info('Converted the legacy state file %(path)s (%(count)d files)' % {'path': self.path, 'count': len(rows)})
+
+class GitWorkTree():
+	"""
+	Git blob IDs of the files under a path inside a git work tree.
+	
+	Blob IDs of the files which are the same as in the git index are read from the index (git ls-files), only the
+	files which differ from the index (git diff-files) and the untracked files are hashed (git hash-object).
+	Ignored files, symbolic links and submodules have no blob ID.
+	
+	If the files (paths as in the asset index) are provided, only those are hashed - the outputs (.min.*,
+	fingerprinted and precompressed files) are often untracked and they don't need a blob ID.
+	"""
+	
+	def __init__(self, path, files = None):
+		self.path = path
+		self.files = files
+		self.root = None
+		self.prefix = None
+		
+		if os.path.exists(GIT_PATH):
+			output = self.__git(['rev-parse', '--show-toplevel'])
+			if output:
+				self.root = output.strip()
+				self.prefix = os.path.relpath(os.path.realpath(path), self.root)
+		
+	def get_blob_ids(self):
+		""" Return a dictionary file path: blob ID (empty if the path is not inside a git work tree). """
+		
+		if not self.root:
+			return {}
+		
+		blob_ids = {}
+		for entry in (self.__git(['ls-files', '--stage', '--full-name', '-z', '--', '.']) or '').split('\0'):
+			if not entry:
+				continue
+			
+			(info, name) = entry.split('\t', 1)
+			(mode, blob_id, stage) = info.split()
+			if stage == '0' and mode in ('100644', '100755'):
+				blob_ids[name] = blob_id
+		
+		modified = [name for name in (self.__git(['diff-files', '--name-only', '-z', '--', '.']) or '').split('\0') if name in blob_ids]
+		untracked = [name for name in (self.__git(['ls-files', '--others', '--exclude-standard', '--full-name', '-z', '--', '.']) or '').split('\0') if name]
+		
+		for name in modified:
+			del blob_ids[name]
+		
+		# Only the modified and the untracked files are read
+		names = [name for name in modified + untracked if (self.files is None or self.__get_file_path(name) in self.files) and '\n' not in name and \
+				os.path.isfile(os.path.join(self.root, name))]
+		if names:
+			output = self.__git(['hash-object', '--stdin-paths'], ''.join([os.path.join(self.root, name) + '\n' for name in names]))
+			if output:
+				blob_ids.update(zip(names, output.split()))
+		
+		logging.info('Git: %(count)d blob IDs read from the index, %(hashed)d files hashed' % {'count': len(blob_ids) - len(names), 'hashed': len(names)})
+		
+		return dict([(self.__get_file_path(name), blob_id) for (name, blob_id) in blob_ids.iteritems()])
+	
+	def hash_files(self, files):
+		""" Return a dictionary file path: blob ID of the provided files (empty if the path is not inside a git work tree). """
+		
+		files = [file for file in files if '\n' not in file and os.path.isfile(file)]
+		if not self.root or not files:
+			return {}
+		
+		output = self.__git(['hash-object', '--stdin-paths'], ''.join([os.path.abspath(file) + '\n' for file in files]))
+		return dict(zip(files, output.split())) if output else {}
+	
+	def __get_file_path(self, name):
+		""" Return the path of the file (under the path the work tree was created with) from its name relative to the git root. """
+		
+		if self.prefix == '.':
+			return os.path.join(self.path, name)
+		
+		return os.path.join(self.path, name[len(self.prefix) + 1:])
+	
+	def __git(self, args, input_data = None):
+		""" Run git in the path and return its output (None if it failed). """
+		
+		try:
+			process = ToolProcess([GIT_PATH] + args, cwd = self.path, stdin = subprocess.PIPE if input_data is not None else None, \
+								stdout = subprocess.PIPE, stderr = subprocess.PIPE, close_fds = True)
+		except OSError, e:
+			logging.error('Git: failed to run git (%(error)s)' % {'error': e})
+			return None
+		
+		output = process.communicate(input_data)[0]
+		return output if process.returncode == 0 else None
+
+class InotifyWatcher():
+	""" Watches the assets path for changed files using Linux inotify. """
+	
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_Q_OVERFLOW = 0x00004000
+	IN_IGNORED = 0x00008000
+	IN_ISDIR = 0x40000000
+	
+	def __init__(self, path):
+		self.path = path
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+		
+		self.fd = self.libc.inotify_init()
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init failed')
+		
+		self.watches = {}
+		self.__add_watches(path)
+		
+	def get_changes(self, timeout = None):
+		"""
+		Wait (at most timeout seconds, forever if timeout is None) for the changes and return a set of changed paths.
+		Directories in the set mean that any of the files in them could have changed.
+		"""
+		
+		changes = set()
+		(readable, writable, errors) = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return changes
+		
+		data = os.read(self.fd, 64 * 1024)
+		offset = 0
+		while offset < len(data):
+			(wd, mask, cookie, length) = struct.unpack_from('iIII', data, offset)
+			name = data[offset + 16:offset + 16 + length].rstrip('\0')
+			offset += 16 + length
+			
+			if mask & self.IN_Q_OVERFLOW:
+				changes.add(self.path)
+			elif mask & self.IN_IGNORED:
+				self.watches.pop(wd, None)
+			elif wd in self.watches:
+				path = os.path.join(self.watches[wd], name)
+				
+				if mask & self.IN_ISDIR:
+					# New directory, files in it could have been created before the watch was added
+					self.__add_watches(path)
+					changes.add(path)
+				elif not mask & self.IN_CREATE:
+					changes.add(path)
+		
+		return changes
+	
+	def __add_watches(self, path):
+		for dir_path, dir_names, file_names in os.walk(path):
+			wd = self.libc.inotify_add_watch(self.fd, dir_path, self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+			if wd >= 0:
+				self.watches[wd] = dir_path
+
+class PollingWatcher():
+	""" Watches the assets path for changed files by periodically rescanning the asset index. """
+	
+	def __init__(self, index, interval):
+		self.index = index
+		self.interval = interval
+		
+	def get_changes(self, timeout = None):
+		""" Wait (at most timeout seconds, forever if timeout is None) for the changes and return a set of changed paths. """
+		
+		deadline = time.time() + timeout if timeout is not None else None
+		while True:
+			if deadline is None:
+				time.sleep(self.interval)
+			else:
+				time.sleep(max(0, min(self.interval, deadline - time.time())))
+			
+			changes = set(self.index.scan())
+			if changes or (deadline is not None and time.time() >= deadline):
+				return changes
+
+class MinifierEngine():
+	"""
+	Base class for the CSS / JavaScript minifier engines.
+	
+	Engine tool name, version and arguments are part of the output cache key, so the engines with a
+	different output must use a different tool name.
+	"""
+	tool = None
+	version = ''
+	args = []
+	
+	def minify(self, code):
+		""" Return the minified code, raise ToolError if the minifier fails. """
+		
+		raise NotImplementedError
+	
+	def minify_file(self, input_file, output_file):
+		""" Minify the input file and write the result to the output file (a new temporary file, never the input file). """
+		
+		with open(input_file, 'rb') as f:
+			code = f.read()
+			
+		output = self.minify(code)
+		with open(output_file, 'wb') as f:
+			f.write(output)
+
+class ExternalMinifierEngine(MinifierEngine):
+	""" Minifies the code with YUI compressor or Closure compiler using the provided function for running the tool. """
+	
+	def __init__(self, tool, args, run_java):
+		self.tool = tool
+		self.args = args
+		self.run_java = run_java
+		
+	def minify(self, code):
+		return self.run_java(self.tool, self.args, code)
+	
+	def minify_file(self, input_file, output_file):
+		if self.tool == 'yui':
+			self.run_java(self.tool, self.args + [os.path.abspath(input_file), '-o', os.path.abspath(output_file)])
+		else:
+			self.run_java(self.tool, self.args + ['--js', os.path.abspath(input_file), '--js_output_file', os.path.abspath(output_file)])
+
+class PythonCSSMinifier(MinifierEngine):
+	"""
+	In-process CSS minifier which follows the YUI compressor rules (comments and whitespace removal,
+	zero values and color shortening).
+	
+	It avoids the tool start up and round trip cost, which dominates the run time for small files.
+	"""
+	tool = 'python-css'
+	version = '2'
+	
+	preserved_re = re.compile(r'/\*.*?\*/|"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|url\((?:[^)"\'\\]|\\.)*\)', re.DOTALL | re.IGNORECASE)
+	preserved_token_re = re.compile(r'___PRESERVED_(?:COMMENT_)?(\d+)___')
+	comment_token_re = re.compile(r'___PRESERVED_COMMENT_\d+___')
+	whitespace_re = re.compile(r'\s+')
+	container_re = re.compile(r'@(?:media|supports|document|-moz-document|(?:-[a-z]+-)?keyframes)\b', re.IGNORECASE)
+	
+	# Whitespace before [ and ( (and after ] and )) is a descendant combinator, so it's only removed on the inner side
+	selector_re = re.compile(r'\s*([,>+~]|[\^$*|]?=)\s*|([\[(])\s+|\s+([\])])')
+	at_rule_re = re.compile(r'\s*([,:])\s*|(\()\s+|\s+(\))')
+	
+	important_re = re.compile(r'\s*!\s*important', re.IGNORECASE)
+	value_punctuation_re = re.compile(r'\s*(,)\s*|(\()\s+|\s+(\))')
+	zero_units_re = re.compile(r'(^|[\s,(])-?(?:0+\.?0*|\.0+)(?:px|em|ex|in|cm|mm|pt|pc)(?![\w%.])', re.IGNORECASE)
+	zero_decimal_re = re.compile(r'(^|[\s,(])-?(?:0+\.0+|\.0+)(?![\w%.])')
+	leading_zero_re = re.compile(r'(^|[\s,(])(-?)0+\.(\d)')
+	zeros_re = re.compile(r'^0(?: 0){1,3}(!important)?$')
+	rgb_re = re.compile(r'rgb\((\d+),(\d+),(\d+)\)', re.IGNORECASE)
+	color_re = re.compile(r'(?<![=\w])#([0-9a-fA-F])\1([0-9a-fA-F])\2([0-9a-fA-F])\3(?![0-9a-fA-F])')
+	opacity_re = re.compile(r'progid:DXImageTransform\.Microsoft\.Alpha\(Opacity=', re.IGNORECASE)
+	
+	shorthand_zero_properties = ('margin', 'padding', 'border-width')
+	none_properties = ('border', 'border-top', 'border-right', 'border-bottom', 'border-left', 'outline', 'background')
+	
+	def minify(self, css):
+		preserved = []
+		
+		def preserve(match):
+			text = match.group(0)
+			if text.startswith('/*') and not text.startswith('/*!'):
+				return ' '
+			
+			if text[:4].lower() == 'url(':
+				text = 'url(' + text[4:-1].strip() + ')'
+			
+			preserved.append(text)
+			return '___PRESERVED_%s%d___' % ('COMMENT_' if text.startswith('/*') else '', len(preserved) - 1)
+		
+		css = self.preserved_re.sub(preserve, css)
+		css = self.whitespace_re.sub(' ', css)
+		
+		(css, position) = self.__minify_block(css, 0, False)
+		return self.preserved_token_re.sub(lambda match: preserved[int(match.group(1))], css)
+	
+	def __minify_block(self, css, position, nested = True):
+		"""
+		Minify the rules until the end of the current block and return the output and the position after the block.
+		
+		Stray } outside of any block are skipped, the preserved comments of the rules which are dropped (empty rules)
+		are kept.
+		"""
+		
+		output = []
+		start = position
+		while position < len(css):
+			char = css[position]
+			
+			if char == ';':
+				statement = self.__minify_at_rule(css[start:position])
+				if statement:
+					output.append(statement + ';')
+				
+				start = position = position + 1
+			elif char == '{':
+				prelude = css[start:position].strip()
+				
+				if self.container_re.match(prelude):
+					(rules, position) = self.__minify_block(css, position + 1)
+					if rules:
+						output.append(self.__minify_at_rule(prelude) + '{' + rules + '}')
+					else:
+						output.extend(self.comment_token_re.findall(prelude))
+				else:
+					end = css.find('}', position)
+					if end == -1:
+						end = len(css)
+					
+					declarations = self.__minify_declarations(css[position + 1:end])
+					if declarations:
+						output.append(self.__minify_selector(prelude) + '{' + declarations + '}')
+					else:
+						output.extend(self.comment_token_re.findall(prelude))
+						
+					position = end + 1
+					
+				start = position
+			elif char == '}' and nested:
+				break
+			elif char == '}':
+				output.extend(self.comment_token_re.findall(css[start:position]))
+				start = position = position + 1
+			else:
+				position += 1
+		
+		statement = self.__minify_at_rule(css[start:position])
+		if statement:
+			output.append(statement)
+			
+		return (''.join(output), position + 1)
+	
+	def __minify_selector(self, selector):
+		selector = self.selector_re.sub(lambda match: ''.join(group or '' for group in match.groups()), selector.strip())
+		
+		# IE 6 needs a space between the :first-letter / :first-line pseudo-element and the block
+		if selector.endswith((':first-letter', ':first-line')):
+			selector += ' '
+			
+		return selector
+	
+	def __minify_at_rule(self, rule):
+		return self.at_rule_re.sub(lambda match: ''.join(group or '' for group in match.groups()), rule.strip())
+	
+	def __minify_declarations(self, block):
+		declarations = []
+		for declaration in block.split(';'):
+			if ':' not in declaration:
+				if declaration.strip():
+					declarations.append(declaration.strip())
+					
+				continue
+			
+			(name, value) = declaration.split(':', 1)
+			name = name.strip()
+			declarations.append(name + ':' + self.__minify_value(name.lower(), value.strip()))
+			
+		return ';'.join(declarations)
+	
+	def __minify_value(self, name, value):
+		value = self.important_re.sub('!important', value)
+		value = self.value_punctuation_re.sub(lambda match: ''.join(group or '' for group in match.groups()), value)
+		value = self.zero_units_re.sub(r'\g<1>0', value)
+		value = self.zero_decimal_re.sub(r'\g<1>0', value)
+		value = self.leading_zero_re.sub(r'\1\2.\3', value)
+		
+		match = self.zeros_re.match(value)
+		if match and name in self.shorthand_zero_properties:
+			value = '0' + (match.group(1) or '')
+		
+		if value.lower() == 'none' and name in self.none_properties:
+			value = '0'
+		
+		value = self.rgb_re.sub(lambda match: '#' + ''.join(['%02x' % (min(int(color), 255)) for color in match.groups()]), value)
+		value = self.color_re.sub(lambda match: ('#' + ''.join(match.groups())).lower(), value)
+		value = self.opacity_re.sub('alpha(opacity=', value)
+		
+		return value
+
+class AssetDeflator():
+	javascript_re = re.compile(r'<script\s*(?:type=["\']?text/javascript["\']?)?>(.*?)</script>', re.DOTALL | re.IGNORECASE)
+	css_re = re.compile(r'<style\s*(?:type=["\']?text/css["\']?)?>(.*?)</style>', re.DOTALL | re.IGNORECASE)
+	report_columns = ['action', 'name', 'queue_wait', 'predicted_time', 'wall_time', 'tool_time', 'tool_cpu_time', 'bytes_in', 'bytes_out']
+	reference_re = re.compile(r'(\b(?:href|src)\s*=\s*["\']?)([^"\'\s>?#]+)', re.IGNORECASE)
+	css_url_re = re.compile(r'(\burl\(\s*["\']?|@import\s+["\'])([^"\'\s)]+)', re.IGNORECASE)
+	file_name_suffix = '.min'
+	
+	def __init__(self, assets_path, actions, overwrite_original, print_statistics, save_state_file = None, \
+				state_file = None, lock_file = '/tmp/asset_deflator.lock', java_workers = 2, jobs = None, cache_directory = None, \
+				cache_size = 1024 * 1024 * 1024, cache_hard_link = False, index_file = None, jpeg_max_quality = None, png_level = None, \
+				gif_level = 2, precompress = False, bundles_manifest = None, python_css_threshold = PYTHON_CSS_MINIFIER_THRESHOLD, \
+				report_file = None, report_top = 10, profile_file = None, fingerprint_manifest = None, fingerprint_templates = False, \
+				shard = None, memory_budget = None, java_heap_size = JAVA_HEAP_SIZE, refine = False, refine_advanced_js = False, \
+				min_savings = MIN_SAVINGS, git = True):
+		self.assets_path = assets_path
+		self.actions = actions
+		self.overwrite_original = overwrite_original
+		self.print_statistics = print_statistics
+		self.save_state_file = save_state_file
+		self.state_file = state_file
+		self.java_workers = java_workers
+		self.index_file = index_file
+		self.precompress = precompress
+		self.bundles_manifest = bundles_manifest
+		self.report_file = report_file
+		self.report_top = report_top
+		self.profile_file = profile_file
+		self.fingerprint_manifest = fingerprint_manifest
+		self.fingerprint_templates = fingerprint_templates
+		self.shard = shard
+		
+		# Every shard (index, count) works on its own slice of the files and writes its own partial state, statistics
+		# and manifest files, which are combined by merge_shards
+		self.stats_file = None
+		if shard:
+			if self.__get_stats_file_name():
+				self.stats_file = self.__get_shard_file_name(self.__get_stats_file_name())
+			
+			if save_state_file:
+				self.save_state_file = self.__get_shard_file_name(save_state_file)
+			
+			if index_file:
+				self.index_file = self.__get_shard_file_name(index_file)
+		
+		# Asset manifest (logical file name: fingerprinted file name, relative to the assets path)
+		self.manifest = {}
+		self.saved_manifest = {}
+		self.loaded_manifest = {}
+		self.fingerprinted_names = {}
+		
+		self.bundles = {}
+		self.bundle_patterns = {}
+		self.bundle_signatures = {}
+		
+		self.input_files = []
+		self.build_databases = {}
+		self.state_file_merged = False
+		self.touched_files = []
+		self.watching = False
+		self.serving = False
+		self.written_files = {}
+		self.java_pool = None
+		self.scheduler = JobScheduler(jobs or multiprocessing.cpu_count(), bool(profile_file))
+		self.memory_budget = MemoryBudget(memory_budget) if memory_budget else None
+		self.java_heap_size = java_heap_size
+		self.admission = None
+		self.stats_lock = threading.Lock()
+		self.run_lock = threading.Lock()
+		self.result_cache = None
+		
+		# Statistics of the task (tool runs) currently worked on by the thread and the profiles of the finished threads
+		self.task_stats = threading.local()
+		self.profiles = []
+		
+		self.cache = OutputCache(cache_directory, cache_size, cache_hard_link) if cache_directory else None
+		self.tool_versions = {}
+		
+		# Outputs are written to temporary files (created with 0600 mode), they get the default mode when they are renamed
+		umask = os.umask(0)
+		os.umask(umask)
+		self.file_mode = 0666 & ~umask
+		
+		self.engines = {'css': [], 'js': []}
+		self.register_engine('css', ExternalMinifierEngine('yui', YUI_COMPRESSOR_CSS_ARGS, self.__run_java))
+		self.register_engine('js', ExternalMinifierEngine('closure', CLOSURE_COMPILER_ARGS, self.__run_java))
+		if python_css_threshold:
+			self.register_engine('css', PythonCSSMinifier(), python_css_threshold)
+		
+		self.image_args = {
+			'jpegoptim': JPEGOPTIM_ARGS + (['--max=%d' % (jpeg_max_quality)] if jpeg_max_quality is not None else []),
+			'optipng': OPTIPNG_ARGS + (['-o%d' % (png_level)] if png_level is not None else []),
+			'gifsicle': GIFSICLE_ARGS + (['-O%d' % (gif_level)] if gif_level is not None else [])
+		}
+		self.images_already_optimized = 0
+		
+		# Refine pass works on the files which haven't reached the refined tier with the slow settings
+		self.refine = refine
+		self.refine_engines = {'css': ExternalMinifierEngine('yui', YUI_COMPRESSOR_CSS_ARGS, self.__run_java)}
+		if refine_advanced_js:
+			self.refine_engines['js'] = ExternalMinifierEngine('closure', CLOSURE_COMPILER_REFINE_ARGS, self.__run_java)
+		self.refine_image_args = {
+			'jpegoptim': self.image_args['jpegoptim'] + JPEGOPTIM_REFINE_ARGS,
+			'optipng': OPTIPNG_ARGS + OPTIPNG_REFINE_ARGS,
+			'gifsicle': GIFSICLE_ARGS + GIFSICLE_REFINE_ARGS
+		}
+		
+		# History (tier, savings ratio and duration) of the files worked on by the previous runs and by this run
+		self.file_history = {}
+		self.min_savings = min_savings / 100.0
+		
+		# Git blob IDs of the files (if the assets path is inside a git work tree) are compared instead of the modification times
+		self.git = git
+		self.git_work_tree = None
+		self.git_blob_ids = {}
+		
+		(file_name, file_extension) = os.path.splitext(lock_file)
+		self.lock_file = file_name + '.'  + hashlib.md5(self.assets_path).hexdigest() + file_extension
+		if shard:
+			self.lock_file = self.__get_shard_file_name(self.lock_file)
+
+		self.__reset_stats()
+		
+	def start(self):
+		""" Start the minification / compilation / compression process. """
+		
+		profiler = self.__start_profiler()
+		self.__prepare(bool(set(self.actions.keys()) & set(['minify_css', 'minify_inline_css', 'compile_js', 'compile_inline_js', 'build_bundles'])))
+		
+		actions = self.__get_actions()
+		for key in self.actions.keys():
+			if key == 'minify_css':
+				actions[key]['input_files'] = self.index.get_files(FILE_EXTENSIONS['css'])
+			elif key == 'minify_inline_css':
+				actions[key]['input_files'] = self.index.get_files_with_inline_code('css')
+			elif key == 'compile_js':
+				actions[key]['input_files'] = self.index.get_files(FILE_EXTENSIONS['js'])
+			elif key == 'compile_inline_js':
+				actions[key]['input_files'] = self.index.get_files_with_inline_code('js')
+			elif key == 'compress_imgs':
+				actions[key]['input_files'] = self.index.get_files(FILE_EXTENSIONS['img'])
+			elif key == 'build_bundles':
+				actions[key]['input_files'] = self.__resolve_bundles()
+		
+		# Bundle inputs must not be overwritten while the bundles are built from them (all the actions are set up at this point)
+		if 'build_bundles' in self.actions and self.overwrite_original:
+			bundle_inputs = set(sum(self.bundles.values(), []))
+			for key in ['minify_css', 'compile_js']:
+				if actions[key]['input_files']:
+					actions[key]['input_files'] = [f for f in actions[key]['input_files'] if f not in bundle_inputs]
+		
+		# Both inline actions work on the same templates, so they are combined into a single pass over the templates
+		if 'minify_inline_css' in self.actions and 'compile_inline_js' in self.actions:
+			css_files = actions['minify_inline_css']['input_files']
+			js_files = actions['compile_inline_js']['input_files']
+			
+			actions['minify_inline_css']['args'] = ['css', 'js']
+			actions['minify_inline_css']['input_files'] = css_files + sorted(set(js_files) - set(css_files))
+			actions['compile_inline_js']['input_files'] = None
+		
+		if self.shard:
+			for key in actions.keys():
+				if actions[key]['input_files'] != None:
+					actions[key]['input_files'] = [f for f in actions[key]['input_files'] if self.__in_shard(f)]
+		
+		refine_keys = ['minify_css', 'compress_imgs'] + (['compile_js'] if 'js' in self.refine_engines else [])
+		refine_files = sum([actions[key]['input_files'] or [] for key in refine_keys], [])
+		
+		self.__skip_not_modified(actions)
+		
+		# Files which haven't reached the refined tier (including the files worked on by this run) are refined
+		if self.refine:
+			actions['refine']['input_files'] = [file for file in refine_files if self.file_history.get(file, {}).get('tier', TIER_FAST) < TIER_REFINED]
+		
+		self.__run_actions(actions)
+		
+		if not self.watching:
+			self.__stop_java_pool()
+			
+		self.__finish(actions)
+		
+		self.__stop_profiler(profiler)
+		self.__save_profile()
+		
+	def __prepare(self, start_java_pool):
+		""" Lock the assets path, start the Java worker pool, load the bundles and the manifest and build the index. """
+		
+		# Only one instance can work on the same path at once
+		try:
+			self.__lock()
+		except IOError:
+			print 'Another instance of Asset Deflator is already running - exiting.'
+			sys.exit(1)
+		
+		atexit.register(self.__delete_lock_file)
+		
+		# Partial state file only holds the files worked on by the last run of the shard
+		if self.shard and self.save_state_file and os.path.exists(self.save_state_file):
+			os.remove(self.save_state_file)
+		
+		if start_java_pool:
+			self.__start_java_pool()
+		
+		# Jobs run in the pool JVMs don't start a JVM of their own
+		job_memory = TOOL_MEMORY if self.java_pool else self.java_heap_size + JAVA_OVERHEAD
+		self.admission = AdmissionController(self.scheduler.workers, job_memory * 1024 * 1024, MEMORY_RESERVE * 1024 * 1024)
+		
+		if self.bundles_manifest:
+			self.__load_bundles()
+		
+		if self.fingerprint_manifest:
+			self.__load_manifest()
+		
+		# Assets path is walked only once and the index is shared by all the actions, bundles are not acted on as regular files
+		phase_start = time.time()
+		self.index = AssetIndex(self.assets_path, self.file_name_suffix, {'css': self.css_re, 'js': self.javascript_re}, self.bundles.keys())
+		if self.index_file:
+			self.index.load(self.index_file)
+			
+		self.index.scan()
+		
+		if self.index_file:
+			self.index.save(self.index_file)
+		
+		self.__add_phase_time('discovery', phase_start)
+		
+	def __skip_not_modified(self, actions):
+		""" Remove the files which weren't modified since the last run from the action input files (if the state file is provided). """
+		
+		if not self.state_file:
+			return
+		
+		self.touched_files = []
+		phase_start = time.time()
+		
+		if self.git:
+			self.git_work_tree = GitWorkTree(self.assets_path, self.index.files)
+			self.git_blob_ids = self.git_work_tree.get_blob_ids()
+		
+		unprofitable_files = []
+		try:
+			database = self.__get_build_database(self.state_file)
+			for key in actions.keys():
+				input_files = actions[key]['input_files']
+				if input_files != None:
+					actions[key]['input_files'] = [f for f in input_files if self.__is_modified(database, f)]
+					
+					if key in ['minify_css', 'compile_js', 'compress_imgs']:
+						unprofitable = set([f for f in actions[key]['input_files'] if self.__is_unprofitable(database, f)])
+						actions[key]['input_files'] = [f for f in actions[key]['input_files'] if f not in unprofitable]
+						unprofitable_files.extend(sorted(unprofitable))
+		except sqlite3.Error, e:
+			self.__state_file_error(self.state_file, e)
+		
+		# Unprofitable files aren't worked on, their existing outputs are kept (the content hasn't changed since they
+		# were written) and the missing outputs are copies of the files
+		for file in unprofitable_files:
+			output_file = self.__get_output_file_name(file)
+			if not os.path.exists(output_file):
+				self.__write_output(output_file, lambda temp_file: shutil.copyfile(file, temp_file))
+			
+			# Only CSS and JavaScript outputs are precompressed
+			if file.split('.')[-1] in FILE_EXTENSIONS['css'] + FILE_EXTENSIONS['js']:
+				self.__precompress(output_file)
+				
+			self.__fingerprint(file, output_file)
+			self.touched_files.append(file)
+		
+		self.unprofitable_count = len(unprofitable_files)
+		self.__add_phase_time('state_load', phase_start)
+		
+	def register_engine(self, type, engine, max_size = None):
+		"""
+		Register a minifier engine for the 'css' or 'js' code.
+		
+		The engines registered later take precedence, the first engine whose max_size (in bytes) is not exceeded
+		by the file / code block is used.
+		"""
+		
+		self.engines[type].insert(0, (max_size, engine))
+		if not isinstance(engine, ExternalMinifierEngine):
+			self.tool_versions[engine.tool] = engine.version
+	
+	def watch(self, poll_interval = 1.0, debounce = 0.5):
+		"""
+		Run all the actions on all the files and then keep watching the assets path and re-run the matching
+		actions on the changed files.
+		
+		Changes are detected using inotify (Linux) or by periodically rescanning the assets path. Bursts of
+		changes are coalesced - actions are only run when no new changes were detected for debounce seconds.
+		"""
+		
+		self.watching = True
+		self.start()
+		
+		try:
+			watcher = InotifyWatcher(self.assets_path)
+			logging.info('Watching %(path)s for changes (inotify)' % {'path': self.assets_path})
+		except (OSError, AttributeError), e:
+			watcher = PollingWatcher(self.index, poll_interval)
+			logging.info('Watching %(path)s for changes (polling every %(interval).1f seconds)' % {'path': self.assets_path, 'interval': poll_interval})
+		
+		changed_paths = set()
+		try:
+			while True:
+				paths = watcher.get_changes(debounce if changed_paths else None)
+				if paths:
+					changed_paths.update(paths)
+					continue
+				
+				if changed_paths:
+					self.__run_changed_files(changed_paths)
+					changed_paths = set()
+		except KeyboardInterrupt:
+			self.__stop_java_pool()
+			
+	def __run_changed_files(self, paths):
+		""" Run the matching actions on the changed files. """
+		
+		files = set()
+		for path in paths:
+			if os.path.isdir(path):
+				# New directory or the watcher lost track of the changes, the index tells which files have changed
+				files.update(self.index.scan())
+			else:
+				files.add(path)
+		
+		actions = self.__get_actions()
+		for file in files:
+			entry = self.index.update_file(file)
+			
+			# Skip the deleted files and the files which were written by the previous run (--overwrite)
+			if not entry or self.written_files.get(file) == (entry['size'], entry['mtime']):
+				continue
+			
+			self.__add_file_action(actions, file, entry)
+		
+		if not [key for key in actions.keys() if actions[key]['input_files']]:
+			return
+		
+		profiler = self.__start_profiler()
+		logging.info('Changed files: %(files)s' % {'files': ', '.join(sorted(sum([actions[key]['input_files'] for key in actions.keys() if actions[key]['input_files']], [])))})
+		
+		self.__reset_stats()
+		self.bundle_signatures = {}
+		self.__run_actions(actions)
+		self.__finish(actions)
+		
+		self.__stop_profiler(profiler)
+		self.__save_profile()
+		
+	def __add_file_action(self, actions, file, entry):
+		""" Add the file to the input files of the matching action (and the bundles built from it to the bundles action). """
+		
+		inline_types = [type for (key, type) in [('minify_inline_css', 'css'), ('compile_inline_js', 'js')] if key in self.actions]
+		
+		bundles = [bundle for (bundle, input_files) in self.bundles.iteritems() if file in input_files and self.__in_shard(bundle)]
+		if bundles and 'build_bundles' in self.actions:
+			actions['build_bundles']['input_files'] = sorted(set((actions['build_bundles']['input_files'] or []) + bundles))
+			
+			if self.overwrite_original:
+				# Bundle inputs must not be overwritten
+				return
+		
+		if entry['extension'] in FILE_EXTENSIONS['css']:
+			key = 'minify_css'
+		elif entry['extension'] in FILE_EXTENSIONS['js']:
+			key = 'compile_js'
+		elif entry['extension'] in FILE_EXTENSIONS['img']:
+			key = 'compress_imgs'
+		elif entry['inline_code'] and set(entry['inline_code']) & set(inline_types):
+			key = 'minify_inline_css' if 'minify_inline_css' in self.actions else 'compile_inline_js'
+			actions[key]['args'] = inline_types
+		else:
+			return
+		
+		if key in self.actions and self.__in_shard(file):
+			actions[key]['input_files'] = (actions[key]['input_files'] or []) + [file]
+		
+	def serve(self, address, result_cache_size = 64 * 1024 * 1024):
+		"""
+		Keep Asset Deflator resident (with the index, the Java worker pool and the result cache) and answer the
+		minify / deflate requests (see DeflatorRequestHandler) over localhost HTTP or a Unix socket.
+		
+		Address is 'unix:/path/to/socket', 'host:port' or 'port' (localhost), the host must be a loopback address.
+		"""
+		
+		if not address.startswith('unix:'):
+			(host, port) = address.rsplit(':', 1) if ':' in address else ('127.0.0.1', address)
+			try:
+				loopback = socket.gethostbyname(host).startswith('127.')
+			except socket.error:
+				loopback = False
+				
+			# The API has no authentication, so it must not be reachable from other machines
+			if not loopback:
+				print 'Server can only listen on a loopback address (%s is not one) - exiting.' % (host)
+				sys.exit(1)
+		
+		self.watching = True
+		self.serving = True
+		self.__prepare(True)
+		self.result_cache = ResultCache(result_cache_size)
+		
+		if address.startswith('unix:'):
+			socket_path = address[len('unix:'):]
+			
+			# Socket left behind by a previous instance (this instance holds the lock)
+			if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+				os.remove(socket_path)
+				
+			server = UnixDeflatorServer(socket_path, DeflatorRequestHandler)
+		else:
+			socket_path = None
+			server = HTTPDeflatorServer((host, int(port)), DeflatorRequestHandler)
+		
+		server.asset_deflator = self
+		logging.info('Server: listening on %(address)s' % {'address': address})
+		
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
+			if socket_path and os.path.exists(socket_path):
+				os.remove(socket_path)
+				
+			self.__stop_java_pool()
+	
+	def minify(self, type, code):
+		"""
+		Minify a block of CSS / JavaScript code and return a (minified code, cached) tuple, the minified code is None
+		if the tool failed.
+		
+		Repeated requests are answered from the in-memory result cache (keyed by the content hash).
+		"""
+		
+		if type not in self.engines:
+			raise ValueError('Unknown code type: %s' % (type))
+		
+		key = hashlib.sha1(type + '\0' + code).hexdigest()
+		output = self.result_cache.get(key)
+		if output is not None:
+			return (output, True)
+		
+		output = self.__compress_inline_block(type, code)
+		if output:
+			self.result_cache.put(key, output)
+			
+		return (output, False)
+	
+	def deflate(self, path):
+		"""
+		Run the actions on all the files under the path (file or directory inside the assets path, relative paths
+		are relative to the assets path) and return the statistics. Runs are serialized, the files which weren't
+		modified are skipped if the state file is provided.
+		
+		Every run opens its own connections to the build databases and closes them at the end, SQLite connections
+		can't be shared by the server threads.
+		"""
+		
+		root = os.path.abspath(self.assets_path)
+		path = os.path.abspath(os.path.join(root, path))
+		if path != root and not path.startswith(root + os.sep):
+			raise ValueError('%s is not inside the assets path' % (path))
+		
+		with self.run_lock:
+			try:
+				return self.__deflate(path)
+			finally:
+				self.__close_build_databases()
+				
+	def __deflate(self, path):
+		self.index.scan()
+		
+		actions = self.__get_actions()
+		for (file, entry) in self.index.files.items():
+			file_path = os.path.abspath(file)
+			if file_path == path or file_path.startswith(path + os.sep):
+				self.__add_file_action(actions, file, entry)
+		
+		# Statistics are reset first, skipping the files which weren't modified records the state load time and the unprofitable files
+		self.__reset_stats()
+		self.__skip_not_modified(actions)
+		
+		self.bundle_signatures = {}
+		self.__run_actions(actions)
+		self.__finish(actions)
+		
+		return {
+			'files': sorted(set(sum([actions[key]['input_files'] for key in actions.keys() if actions[key]['input_files']], []))),
+			'failed': sorted(self.failed_files),
+			'size_before': sum(self.size_before.values()),
+			'size_after': sum(self.size_after.values()),
+			'running_time': self.end_time - self.start_time,
+			'phases': self.phase_times
+		}
+		
+	def __reset_stats(self):
+		""" Reset the statistics. """
+		
+		self.files_count = 0
+		self.size_before = {'css': 0, 'js': 0, 'tpl': 0, 'img': 0, 'bundle': 0}
+		self.size_after = {'css': 0, 'js': 0, 'tpl': 0, 'img': 0, 'bundle': 0}
+		
+		# Sizes of the gzip / brotli compressed copies of the outputs
+		self.precompressed_size_before = {'gz': 0, 'br': 0}
+		self.precompressed_size_after = {'gz': 0, 'br': 0}
+		
+		# Wall time (in seconds) of the run phases (discovery, state_load, state_save and the actions)
+		self.phase_times = {}
+		
+		# Statistics of every job (file, block of inline code or bundle) worked on
+		self.tasks = []
+		
+		# Refined outputs which were smaller than the regular outputs and the bytes saved by them
+		self.refined_count = 0
+		self.refined_size_saved = 0
+		
+		# Files which weren't worked on because the last run saved less than the minimum savings
+		self.unprofitable_count = 0
+		
+		# Files (and bundles) whose tool failed, they are not saved in the state so the next run works on them again
+		self.failed_files = set()
+		
+	def __get_actions(self):
+		""" Return the actions description, input files are set to None (action doesn't run). """
+		
+		return {
+				'minify_css': {'action': 'minify_css', 'args': None, 'input_files': None},
+				'minify_inline_css': {'action': 'compress_inline_code', 'args': 'css', 'input_files': None},
+				'compile_js': {'action': 'compile_javascript', 'args': None, 'input_files': None},
+				'compile_inline_js': {'action': 'compress_inline_code', 'args': 'js', 'input_files': None},
+				'compress_imgs': {'action': 'compress_images', 'args': None, 'input_files': None},
+				'build_bundles': {'action': 'build_bundles', 'args': None, 'input_files': None},
+				'refine': {'action': 'refine_files', 'args': None, 'input_files': None}
+		}
+			
+	def __run_actions(self, actions):
+		""" Run the actions on their input files. """
+		
+		self.start_time = time.time()
+		self.scheduler.start()
+		
+		# When the references in the templates are rewritten to the fingerprinted names, templates are worked on
+		# after all the other files are fingerprinted, the files are refined after all the regular outputs are written
+		template_keys = ['minify_inline_css', 'compile_inline_js']
+		templates_wave = [key for key in self.actions.keys() if key in template_keys]
+		if self.fingerprint_templates:
+			waves = [[key for key in self.actions.keys() if key not in template_keys]] + ([['refine']] if self.refine else []) + [templates_wave]
+		else:
+			waves = [self.actions.keys()] + ([['refine']] if self.refine else [])
+		
+		manifest = dict(self.manifest)
+		for wave in waves:
+			if self.fingerprint_templates and wave is templates_wave:
+				if self.manifest != manifest:
+					self.__add_all_templates(actions)
+					
+				self.__build_fingerprinted_names()
+			
+			# Actions only queue their jobs in the global job queue and wait for them to finish
+			workers = []
+			for key in wave:
+				action = getattr(self, actions[key]['action'])
+				args = actions[key]['args']
+				files = actions[key]['input_files']
+				
+				if files is not None:
+					workers.append(threading.Thread(target = self.__run_action, args = (key, action, (args, files) if args else (files,))))
+						
+			for worker in workers:
+				worker.start()
+			
+			for worker in workers:
+				worker.join()
+		
+		self.scheduler.stop()
+		self.end_time = time.time()
+		
+	def __run_action(self, key, action, args):
+		""" Run the action and record its wall time. """
+		
+		profiler = self.__start_profiler()
+		phase_start = time.time()
+		
+		action(*args)
+		
+		self.__add_phase_time(key, phase_start)
+		self.__stop_profiler(profiler)
+	
+	def __run_batch(self, action, jobs):
+		"""
+		Run a batch of (size, name, output_file, function, args) jobs with the scheduler and return the results.
+		
+		Queue wait, predicted and wall time, tool wall and CPU time and bytes in / out are recorded for every job,
+		the bytes out are the length of the job result or the size of the output file.
+		
+		Jobs are scheduled by their predicted duration - the duration of the last run for the files worked on
+		before, otherwise the size divided by the throughput of the files in the batch with a known duration.
+		"""
+		
+		durations = [(size, self.file_history[name]['duration']) for (size, name, output_file, function, args) in jobs \
+					if self.file_history.get(name, {}).get('duration') is not None]
+		throughput = DEFAULT_THROUGHPUT
+		if durations and sum([duration for (size, duration) in durations]) > 0:
+			throughput = sum([size for (size, duration) in durations]) / sum([duration for (size, duration) in durations])
+		
+		queued = time.time()
+		tasks = []
+		for (size, name, output_file, function, args) in jobs:
+			duration = self.file_history.get(name, {}).get('duration')
+			predicted_time = duration if duration is not None else size / float(throughput)
+			tasks.append((predicted_time, self.__run_task, (action, name, size, predicted_time, output_file, queued, function, args)))
+			
+		return self.scheduler.run_batch(tasks)
+	
+	def __run_task(self, action, name, size, predicted_time, output_file, queued, function, args):
+		# Time spent waiting for the admission and the memory budget is a part of the queue wait
+		if self.admission:
+			self.admission.acquire()
+			
+		reserved_size = self.memory_budget.acquire(size) if self.memory_budget else 0
+		
+		self.task_stats.tool_time = 0.0
+		self.task_stats.tool_cpu_time = 0.0
+		start_time = time.time()
+		
+		try:
+			result = function(*args)
+		except Exception:
+			with self.stats_lock:
+				self.failed_files.add(name)
+			raise
+		finally:
+			if self.memory_budget:
+				self.memory_budget.release(reserved_size)
+				
+			if self.admission:
+				self.admission.release()
+		
+		end_time = time.time()
+		if isinstance(result, basestring):
+			bytes_out = len(result)
+		elif output_file and os.path.exists(output_file):
+			bytes_out = os.path.getsize(output_file)
+		else:
+			bytes_out = None
+		
+		with self.stats_lock:
+			self.tasks.append({'action': action, 'name': name, 'queue_wait': start_time - queued, 'predicted_time': predicted_time, \
+							'wall_time': end_time - start_time, 'tool_time': self.task_stats.tool_time, 'tool_cpu_time': self.task_stats.tool_cpu_time, \
+							'bytes_in': size, 'bytes_out': bytes_out})
+			
+			# Job functions return False if the tool failed (the output is the previous one)
+			if result is False:
+				self.failed_files.add(name)
+			
+			# Savings ratio and duration of the files worked on by the regular actions are kept in the state
+			elif action in ['minify_css', 'compile_js', 'compress_imgs'] and bytes_out is not None:
+				self.file_history[name] = {'tier': TIER_FAST, 'savings': 1 - float(bytes_out) / size if size else 0.0, 'duration': end_time - start_time}
+			
+		return result
+	
+	def __add_tool_time(self, start_time, rusage = None):
+		""" Add the tool run wall time and CPU time (from the process resource usage) to the statistics of the current task. """
+		
+		if hasattr(self.task_stats, 'tool_time'):
+			self.task_stats.tool_time += time.time() - start_time
+			if rusage:
+				self.task_stats.tool_cpu_time += rusage.ru_utime + rusage.ru_stime
+	
+	def __get_slowest_tasks(self):
+		return sorted(self.tasks, key = operator.itemgetter('wall_time'), reverse = True)[:self.report_top]
+	
+	def __save_report(self, report_file):
+		""" Save the phase and task statistics as CSV (if the report file name ends with .csv) or JSON. """
+		
+		if report_file.endswith('.csv'):
+			with open(report_file, 'wb') as file:
+				writer = csv.writer(file)
+				writer.writerow(self.report_columns)
+				writer.writerows([[task[column] for column in self.report_columns] for task in sorted(self.tasks, key = operator.itemgetter('wall_time'), reverse = True)])
+		else:
+			with open(report_file, 'w') as file:
+				json.dump(self.__get_report(), file, indent = 4, sort_keys = True)
+	
+	def __get_report(self):
+		""" Return the report with the statistics, the phase times, the per action totals and the task statistics. """
+		
+		actions = {}
+		for task in self.tasks:
+			totals = actions.setdefault(task['action'], {'tasks': 0, 'queue_wait': 0, 'predicted_time': 0, 'wall_time': 0, 'tool_time': 0, 'tool_cpu_time': 0, \
+												'bytes_in': 0, 'bytes_out': 0})
+			totals['tasks'] += 1
+			for column in self.report_columns[2:]:
+				totals[column] += task[column] or 0
+		
+		return {
+			'assets_path': self.assets_path,
+			'running_time': self.end_time - self.start_time,
+			'stats': {
+				'actions': self.actions.keys(),
+				'files_count': self.files_count,
+				'size_before': self.size_before,
+				'size_after': self.size_after,
+				'precompressed_size_before': self.precompressed_size_before,
+				'precompressed_size_after': self.precompressed_size_after,
+				'images_already_optimized': self.images_already_optimized
+			},
+			'phases': self.phase_times,
+			'concurrency': self.admission.changes if self.admission else [],
+			'actions': actions,
+			'slowest': self.__get_slowest_tasks(),
+			'tasks': self.tasks
+		}
+	
+	def __start_profiler(self):
+		""" Start profiling the current thread (if enabled). """
+		
+		if not self.profile_file:
+			return None
+		
+		profiler = cProfile.Profile()
+		profiler.enable()
+		
+		return profiler
+	
+	def __stop_profiler(self, profiler):
+		if profiler:
+			profiler.disable()
+			with self.stats_lock:
+				self.profiles.append(profiler)
+	
+	def __save_profile(self):
+		""" Merge the profiles of all the threads and save them to the profile file (readable with pstats). """
+		
+		profiles = self.profiles + self.scheduler.profiles
+		if not self.profile_file or not profiles:
+			return
+		
+		stats = pstats.Stats(profiles[0])
+		for profile in profiles[1:]:
+			stats.add(profile)
+		
+		stats.dump_stats(self.profile_file)
+	
+	def __add_phase_time(self, phase, start_time):
+		with self.stats_lock:
+			self.phase_times[phase] = self.phase_times.get(phase, 0) + time.time() - start_time
+		
+	def __finish(self, actions):
+		""" Evict old cache entries, save the state and print the statistics. """
+		
+		if self.cache:
+			self.cache.evict()
+		
+		input_files = [actions[key]['input_files'] for key in actions.keys() \
+					if actions[key]['input_files'] != None]
+		input_files = [file for file in sum(input_files, []) if file not in self.failed_files]
+		
+		# Remember what the files written by this run look like, so the watcher doesn't act on them again
+		if self.overwrite_original:
+			for file in input_files:
+				if os.path.exists(file):
+					self.written_files[file] = (os.path.getsize(file), os.path.getmtime(file))
+		
+		# If the --save-state option is provided, save the state of all the input files which were modified
+		# (and of the files which were only touched, so their content isn't hashed again on the next run)
+		if self.save_state_file and (input_files or self.touched_files or self.shard):
+			phase_start = time.time()
+			
+			# Overwritten files don't have the content of the blob anymore
+			if self.overwrite_original and self.git_blob_ids:
+				self.git_blob_ids.update(self.git_work_tree.hash_files(input_files))
+			
+			try:
+				self.__save_state_file([self.__get_state_row(file) for file in input_files + self.touched_files if os.path.exists(file)])
+			except sqlite3.Error, e:
+				self.__state_file_error(self.save_state_file, e)
+			
+			self.touched_files = []
+			self.__add_phase_time('state_save', phase_start)
+		
+		self.file_history = {}
+		self.git_blob_ids = {}
+
+		if self.fingerprint_manifest and self.manifest != self.saved_manifest:
+			self.__save_manifest()
+		
+		if self.stats_file:
+			with open(self.stats_file, 'w') as file:
+				json.dump(self.__get_report(), file, indent = 4, sort_keys = True)
+		elif self.report_file:
+			self.__save_report(self.report_file)
+		
+		if self.print_statistics:
+			self.print_stats()
+		
+	def merge_shards(self, count):
+		"""
+		Merge the partial state, statistics and manifest files written by the shards (1 to count) into the state file,
+		the report and the manifest (and print the merged statistics). Partial files are deleted after the merge.
+		"""
+		
+		shards = [(index, count) for index in range(1, count + 1)]
+		stats_file = self.__get_stats_file_name()
+		
+		partial_files = []
+		for file_name in [self.save_state_file, stats_file]:
+			if file_name:
+				partial_files.extend([self.__get_shard_file_name(file_name, shard) for shard in shards])
+		
+		missing_files = [file for file in partial_files if not os.path.exists(file)]
+		if missing_files:
+			print 'Partial files %s are missing (not all the shards have finished?) - exiting.' % (', '.join(missing_files))
+			sys.exit(1)
+		
+		if self.save_state_file:
+			try:
+				database = self.__get_build_database(self.save_state_file)
+				for shard in shards:
+					database.merge(self.__get_shard_file_name(self.save_state_file, shard))
+			except sqlite3.Error, e:
+				self.__state_file_error(self.save_state_file, e)
+		
+		# Shards only write the manifest entries which have changed
+		if self.fingerprint_manifest:
+			self.__load_manifest()
+			for shard in shards:
+				manifest_file = self.__get_shard_file_name(self.fingerprint_manifest, shard)
+				if os.path.exists(manifest_file):
+					with open(manifest_file, 'r') as file:
+						self.manifest.update(json.load(file))
+						
+					partial_files.append(manifest_file)
+					
+			self.__save_manifest()
+		
+		if stats_file:
+			reports = []
+			for shard in shards:
+				with open(self.__get_shard_file_name(stats_file, shard), 'r') as file:
+					reports.append(json.load(file))
+			
+			self.actions = dict([(action, True) for report in reports for action in report['stats']['actions']])
+			self.files_count = sum([report['stats']['files_count'] for report in reports])
+			self.images_already_optimized = sum([report['stats']['images_already_optimized'] for report in reports])
+			for name in ['size_before', 'size_after', 'precompressed_size_before', 'precompressed_size_after']:
+				setattr(self, name, dict([(key, sum([report['stats'][name][key] for report in reports])) for key in getattr(self, name).keys()]))
+			
+			# Shards run at the same time
+			self.phase_times = dict([(phase, max([report['phases'].get(phase, 0) for report in reports])) \
+									for phase in set(sum([report['phases'].keys() for report in reports], []))])
+			(self.start_time, self.end_time) = (0, max([report['running_time'] for report in reports]))
+			self.tasks = sum([report['tasks'] for report in reports], [])
+			self.assets_path = self.assets_path or reports[0]['assets_path']
+			
+			if self.report_file:
+				self.__save_report(self.report_file)
+			
+			if self.print_statistics:
+				self.print_stats()
+		
+		for file in partial_files:
+			os.remove(file)
+		
+	def __in_shard(self, file):
+		""" Return True if the file belongs to this shard (files are assigned by the hash of the path relative to the assets path). """
+		
+		if not self.shard:
+			return True
+		
+		(index, count) = self.shard
+		path = os.path.relpath(file, self.assets_path).replace(os.sep, '/')
+		
+		return int(hashlib.md5(path).hexdigest()[:8], 16) % count == index - 1
+	
+	def __get_shard_file_name(self, file_name, shard = None):
+		""" Return the name of the partial file written by the shard (state.db -> state.shard-1-of-4.db). """
+		
+		(index, count) = shard or self.shard
+		(name, extension) = os.path.splitext(file_name)
+		
+		return '%s.shard-%d-of-%d%s' % (name, index, count, extension)
+	
+	def __get_stats_file_name(self):
+		""" Return the name of the statistics file (next to the report or the state file) written by the shards. """
+		
+		file_name = self.report_file or self.save_state_file
+		if not file_name:
+			return None
+		
+		return os.path.splitext(file_name)[0] + '.stats.json'
+		
+	def minify_css(self, css_files):
+		""" Minify CSS files. """
+		
+		if not css_files:
+			return
+		
+		logging.info('CSS minification: start')
+		self.size_before['css'] = self.__calculate_files_size(css_files)
+		self.__add_files_count(len(css_files))
+
+		self.__run_batch('minify_css', [(os.path.getsize(file), file, self.__get_output_file_name(file), self.__minify_css_file, (file,)) \
+										for file in css_files])
+		
+		if self.overwrite_original:
+			self.size_after['css'] = self.__calculate_files_size(css_files)
+		else:
+			self.size_after['css'] = self.__calculate_files_size(map(self.__get_file_name_with_suffix, css_files))
+
+		logging.info('CSS minification: completed')
+				
+	def compile_javascript(self, javascript_files):
+		""" Compile JavaScript files with Google Closure Compiler. """
+		
+		if not javascript_files:
+			return
+		
+		logging.info('JavaScript compilation: start')
+		self.size_before['js'] = self.__calculate_files_size(javascript_files)
+		
+		self.__run_batch('compile_js', [(os.path.getsize(file), file, self.__get_output_file_name(file), self.__compile_javascript_file, (file,)) \
+										for file in javascript_files])
+		
+		if self.overwrite_original:
+			self.size_after['js'] = self.__calculate_files_size(javascript_files)
+		else:
+			self.size_after['js'] = self.__calculate_files_size(map(self.__get_file_name_with_suffix, javascript_files))
+		
+		logging.info('JavaScript compilation: completed')
+		
+	def compress_inline_code(self, types, files):
+		"""
+		Compress inline CSS and / or JavaScript code (types is 'css', 'js' or a list of them).
+		
+		Every template is read, parsed and written only once, even if both inline CSS and inline
+		JavaScript are compressed. Templates are memory mapped and streamed to the output, only the
+		blocks of inline code are kept in memory.
+		"""
+		
+		if isinstance(types, basestring):
+			types = [types]
+		
+		types = [type for type in types if type in ['css', 'js']]
+		if not files or not types:
+			return
+		
+		description = ' and '.join(['CSS' if type == 'css' else 'JavaScript' for type in types])
+		logging.info('Inline %(type)s compression: start' % {'type': description})
+		self.size_before['tpl'] = self.__calculate_files_size(files)
+		self.__add_files_count(len(files))
+		
+		# Find the blocks of inline code by their position in the template
+		templates = []
+		blocks = {}
+		for file in files:
+			with MappedFile(file) as content:
+				spans = []
+				for type in types:
+					regular_expression = self.css_re if type == 'css' else self.javascript_re
+					spans.extend([match.span(1) + (type,) for match in regular_expression.finditer(content)])
+				
+				spans = self.__remove_nested_spans(spans)
+				templates.append((file, len(content), spans))
+				for (start, end, type) in spans:
+					blocks.setdefault((type, content[start:end]), file)
+		
+		# Every distinct block of code is compressed only once (the same block is often repeated in many templates),
+		# every block is a separate job (reported under the first template it was found in) and CSS and JavaScript
+		# blocks are compressed at the same time
+		blocks = [(type, block, file) for ((type, block), file) in blocks.iteritems() if block.strip()]
+		compressed_blocks = dict(zip([(type, block) for (type, block, file) in blocks], \
+									self.__run_batch('inline_block', [(len(block), '%s (inline %s)' % (file, type), None, self.__compress_inline_block, (type, block)) \
+																	for (type, block, file) in blocks])))
+		
+		self.__run_batch('template', [(size, file, self.__get_output_file_name(file), self.__write_template, (file, spans, compressed_blocks)) \
+									for (file, size, spans) in templates])
+ 
+		self.size_after['tpl'] = self.__calculate_files_size(map(self.__get_output_file_name, files))
+		logging.info('Inline %(type)s compression: completed' % {'type': description})
+		
+	def build_bundles(self, bundles):
+		""" Build the bundles, every bundle is built with a single Closure compiler / YUI compressor run. """
+		
+		if not bundles:
+			return
+		
+		logging.info('Bundles: start')
+		self.size_before['bundle'] = self.__calculate_files_size(sum([self.bundles[bundle] for bundle in bundles], []))
+		self.__add_files_count(len(bundles))
+		
+		self.__run_batch('build_bundles', [(self.__calculate_files_size(self.bundles[bundle]), bundle, bundle, self.__build_bundle, (bundle,)) \
+											for bundle in bundles])
+		
+		self.size_after['bundle'] = self.__calculate_files_size(bundles)
+		logging.info('Bundles: completed')
+		
+	def __build_bundle(self, bundle):
+		""" Build a single bundle. """
+		
+		input_files = self.bundles[bundle]
+		if not os.path.isdir(os.path.dirname(bundle)):
+			os.makedirs(os.path.dirname(bundle))
+			
+		key = self.__get_bundle_signature(bundle)
+		if not self.cache or not self.cache.get(key, bundle):
+			if not self.__write_output(bundle, lambda temp_file: self.__write_bundle(bundle, input_files, temp_file), key if self.cache else None):
+				return False
+				
+		self.__precompress(bundle)
+		self.__fingerprint(bundle, bundle)
+		return True
+		
+	def __write_bundle(self, bundle, input_files, output_file):
+		if bundle.endswith('.js'):
+			self.__run_java('closure', CLOSURE_COMPILER_ARGS + sum([['--js', os.path.abspath(file)] for file in input_files], []) + \
+							['--js_output_file', os.path.abspath(output_file)])
+		else:
+			code = []
+			for file in input_files:
+				with open(file, 'rb') as f:
+					code.append(self.__rewrite_css_urls(f.read(), os.path.dirname(file), os.path.dirname(bundle)))
+			
+			output = self.__get_bundle_engine(bundle).minify('\n'.join(code))
+			with open(output_file, 'wb') as f:
+				f.write(output)
+		
+	def __rewrite_css_urls(self, code, input_directory, bundle_directory):
+		""" Rewrite the relative url() / @import references of a bundled CSS file against the directory of the bundle. """
+		
+		if os.path.abspath(input_directory) == os.path.abspath(bundle_directory):
+			return code
+		
+		def rewrite(match):
+			url = match.group(2)
+			if ':' in url or url.startswith('/') or url.startswith('#'):
+				return match.group(0)
+			
+			path = os.path.relpath(os.path.join(input_directory, url), bundle_directory or os.curdir)
+			return match.group(1) + path.replace(os.sep, '/')
+		
+		return self.css_url_re.sub(rewrite, code)
+	
+	def __load_bundles(self):
+		"""
+		Load the bundles manifest - a JSON object which maps the bundle file names to the ordered lists of input
+		file names or glob patterns (all relative to the assets path).
+		"""
+		
+		with open(self.bundles_manifest, 'r') as file:
+			manifest = json.load(file)
+		
+		self.bundle_patterns = dict([(os.path.join(self.assets_path, bundle), patterns) for (bundle, patterns) in manifest.iteritems()])
+		self.bundles = dict([(bundle, []) for bundle in self.bundle_patterns.keys()])
+	
+	def __resolve_bundles(self):
+		""" Expand the glob patterns of the bundle inputs and return a list of the bundles which can be built. """
+		
+		bundles = []
+		for (bundle, patterns) in self.bundle_patterns.iteritems():
+			if os.path.splitext(bundle)[1] not in ['.js', '.css']:
+				logging.error('Bundle %(bundle)s is not a JavaScript or CSS file, skipping it' % {'bundle': bundle})
+				continue
+			
+			input_files = []
+			for pattern in patterns:
+				pattern = os.path.join(self.assets_path, pattern)
+				
+				if glob.has_magic(pattern):
+					matches = sorted([file for file in glob.glob(pattern) if os.path.basename(file).find(self.file_name_suffix) == -1])
+				else:
+					matches = [pattern]
+					
+				input_files.extend([file for file in matches if file not in input_files and file not in self.bundle_patterns])
+			
+			missing_files = [file for file in input_files if not os.path.isfile(file)]
+			if missing_files:
+				logging.error('Bundle %(bundle)s input files %(files)s don\'t exist, skipping it' % {'bundle': bundle, 'files': ', '.join(missing_files)})
+				continue
+			
+			self.bundles[bundle] = input_files
+			if input_files:
+				bundles.append(bundle)
+		
+		return bundles
+	
+	def __get_bundle_signature(self, bundle):
+		""" Return a hash of the bundle name, inputs (file names and contents), tool version and tool arguments. """
+		
+		with self.stats_lock:
+			if bundle in self.bundle_signatures:
+				return self.bundle_signatures[bundle]
+		
+		engine = self.__get_bundle_engine(bundle)
+		(tool, args) = (engine.tool, engine.args)
+		signature = hashlib.sha1('\0'.join([bundle, tool, self.__get_tool_version(tool)] + args + \
+								['%s:%s' % (file, self.__get_file_hash(file)) for file in self.bundles[bundle]])).hexdigest()
+		
+		with self.stats_lock:
+			self.bundle_signatures[bundle] = signature
+		
+		return signature
+	
+	def __get_bundle_engine(self, bundle):
+		""" Return the minifier engine for the bundle (selected by the total size of the input files). """
+		
+		if bundle.endswith('.js'):
+			return self.__get_engine('js', sys.maxint)
+		
+		return self.__get_engine('css', self.__calculate_files_size(self.bundles[bundle]))
+	
+	def __is_modified(self, database, file):
+		"""
+		Return True if the file (or the tool used for it) has changed since it was saved in the build database.
+		
+		Files with a different modification time but the same size are hashed and skipped if their content
+		hasn't changed (their row is updated on save). Rows converted from a legacy state file only hold
+		the modification time (or the signature for bundles).
+		"""
+		
+		row = database.get(file)
+		if not row:
+			return True
+		
+		# Duration of the last run is used to predict the cost, the tier and the savings are kept only while the file doesn't change
+		self.file_history[file] = {'tier': TIER_FAST, 'savings': None, 'duration': row['duration']}
+		
+		if file in self.bundles:
+			return row['content_hash'] != self.__get_bundle_signature(file)
+		
+		if row['tool_version'] is not None and row['tool_version'] != self.__get_file_tool_version(file):
+			return True
+		
+		if not self.overwrite_original and not os.path.exists(self.__get_output_file_name(file)):
+			return True
+		
+		# Blob IDs don't change with the checkout (unlike the modification times) and the file content is not read
+		blob_id = self.git_blob_ids.get(file)
+		if blob_id and row['blob_id']:
+			if blob_id != row['blob_id']:
+				return True
+			
+			self.file_history[file].update({'tier': row['tier'] or TIER_FAST, 'savings': row['savings']})
+			return False
+		
+		entry = self.index.files[file]
+		if row['mtime'] == entry['mtime'] and row['size'] in (None, entry['size']):
+			self.file_history[file].update({'tier': row['tier'] or TIER_FAST, 'savings': row['savings']})
+			
+			# Blob ID is saved, so the next run can compare it
+			if blob_id:
+				self.touched_files.append(file)
+				
+			return False
+		
+		if row['size'] == entry['size'] and row['content_hash'] == self.__get_file_hash(file):
+			self.file_history[file].update({'tier': row['tier'] or TIER_FAST, 'savings': row['savings']})
+			self.touched_files.append(file)
+			return False
+		
+		return True
+	
+	def __is_unprofitable(self, database, file):
+		"""
+		Return True if the file would be worked on again although its content hasn't changed (the tool has changed or
+		the output is missing) and the last run saved less than the minimum savings.
+		"""
+		
+		if self.min_savings <= 0:
+			return False
+		
+		row = database.get(file)
+		if not row or row['savings'] is None or row['savings'] >= self.min_savings:
+			return False
+		
+		blob_id = self.git_blob_ids.get(file)
+		if blob_id and row['blob_id']:
+			if blob_id != row['blob_id']:
+				return False
+		elif row['size'] != self.index.files[file]['size'] or row['content_hash'] != self.__get_file_hash(file):
+			return False
+		
+		self.file_history[file].update({'tier': row['tier'] or TIER_FAST, 'savings': row['savings']})
+		return True
+	
+	def __get_state_row(self, file):
+		""" Return the build database row for the file after it was worked on. """
+		
+		stat = os.stat(file)
+		if file in self.bundles:
+			return (file, stat.st_size, stat.st_mtime, self.__get_bundle_signature(file), self.__get_file_hash(file), \
+					self.__get_file_tool_version(file), TIER_FAST, None, self.file_history.get(file, {}).get('duration'), None)
+		
+		content_hash = self.__get_file_hash(file)
+		output_file = self.__get_output_file_name(file)
+		output_hash = self.__get_file_hash(output_file) if output_file != file and os.path.exists(output_file) else content_hash
+		
+		history = self.file_history.get(file, {})
+		
+		return (file, stat.st_size, stat.st_mtime, content_hash, output_hash, self.__get_file_tool_version(file), history.get('tier', TIER_FAST), \
+				history.get('savings'), history.get('duration'), self.git_blob_ids.get(file))
+	
+	def __get_file_tool_version(self, file):
+		""" Return the name and the version of the tools which work on the file. """
+		
+		if file in self.bundles:
+			tools = [self.__get_bundle_engine(file).tool]
+		else:
+			entry = self.index.files[file]
+			
+			if entry['extension'] in FILE_EXTENSIONS['css']:
+				tools = [self.__get_engine('css', entry['size']).tool]
+			elif entry['extension'] in FILE_EXTENSIONS['js']:
+				tools = [self.__get_engine('js', entry['size']).tool]
+			elif entry['extension'] in FILE_EXTENSIONS['img']:
+				tools = [{'jpg': 'jpegoptim', 'jpeg': 'jpegoptim', 'png': 'optipng', 'gif': 'gifsicle'}[entry['extension']]]
+			else:
+				# Inline code blocks can be minified by any of the engines
+				tools = [engine.tool for type in (entry['inline_code'] or []) for (max_size, engine) in self.engines[type]]
+		
+		return ','.join(['%s:%s' % (tool, self.__get_tool_version(tool)) for tool in tools])
+	
+	def __write_template(self, file, spans, compressed_blocks):
+		"""
+		Replace the non-compressed code with the compressed one in a single pass and write the template.
+		
+		The template is streamed from its memory map to a temporary file, which is renamed to the output
+		file at the end. Returns False if any of the blocks couldn't be compressed (it's left as it is).
+		"""
+		
+		output_file = self.__get_output_file_name(file)
+		failed = False
+		with MappedFile(file) as content:
+			with open(output_file + '.tmp', 'wb') as output:
+				position = 0
+				for (start, end, type) in spans:
+					block = content[start:end]
+					compressed_block = compressed_blocks.get((type, block))
+					if compressed_block is None:
+						failed = failed or bool(block.strip())
+						compressed_block = block
+					
+					self.__copy_template_text(output, content, position, start)
+					output.write(self.reference_re.sub(self.__rewrite_reference, compressed_block) if self.fingerprint_templates else compressed_block)
+					position = end
+				
+				self.__copy_template_text(output, content, position, len(content))
+		
+		if output_file == file:
+			shutil.copymode(file, output_file + '.tmp')
+			
+		os.rename(output_file + '.tmp', output_file)
+		self.__precompress(output_file)
+		return not failed
+	
+	def __copy_template_text(self, output, content, start, end):
+		""" Copy the template text between start and end in chunks (and rewrite the references to the fingerprinted files). """
+		
+		if self.fingerprint_templates:
+			for match in self.reference_re.finditer(content, start, end):
+				self.__copy_template_text_chunks(output, content, start, match.start())
+				output.write(self.__rewrite_reference(match))
+				start = match.end()
+				
+		self.__copy_template_text_chunks(output, content, start, end)
+	
+	def __copy_template_text_chunks(self, output, content, start, end):
+		for position in xrange(start, end, STREAM_CHUNK_SIZE):
+			output.write(content[position:min(position + STREAM_CHUNK_SIZE, end)])
+		
+	def compress_images(self, image_files):
+		""" Compress images using jpegoptim / optipng / gifsicle tool. """
+		
+		if not image_files:
+			return
+		
+		logging.info('Image compression: start')
+		self.size_before['img'] = self.__calculate_files_size(image_files)
+		self.__add_files_count(len(image_files))
+		
+		tools = {'jpg': 'jpegoptim', 'jpeg': 'jpegoptim', 'png': 'optipng', 'gif': 'gifsicle'}
+		self.__run_batch('compress_imgs', [(os.path.getsize(file), file, self.__get_output_file_name(file), self.__compress_image_file, \
+											(file, tools[file.split('.')[-1]])) for file in image_files])
+		
+		if self.overwrite_original:
+			self.size_after['img'] = self.__calculate_files_size(image_files)
+		else:
+			self.size_after['img'] = self.__calculate_files_size(map(self.__get_file_name_with_suffix, image_files))
+		
+		logging.info('Image compression: completed')
+		
+	def refine_files(self, files):
+		"""
+		Work on the CSS, JavaScript and image files again with the slow settings and replace the outputs
+		with the refined outputs which are smaller. Files are marked as refined either way.
+		"""
+		
+		if not files:
+			return
+		
+		logging.info('Refinement: start')
+		
+		self.__run_batch('refine', [(os.path.getsize(file), file, self.__get_output_file_name(file), self.__refine_file, (file,)) for file in files])
+		
+		logging.info('Refinement: completed, %(count)d of %(total)d outputs replaced' % {'count': self.refined_count, 'total': len(files)})
+		
+	def __minify_css_file(self, file):
+		""" Minify a single CSS file, returns False if the minifier failed. """
+		
+		return self.__minify_file('css', file)
+		
+	def __compile_javascript_file(self, file):
+		""" Compile a single JavaScript file, returns False if the compiler failed. """
+		
+		return self.__minify_file('js', file)
+		
+	def __minify_file(self, type, file):
+		output_file = self.__get_output_file_name(file)
+		engine = self.__get_engine(type, os.path.getsize(file))
+		
+		if not self.__run_cached(engine.tool, engine.args, file, output_file, lambda temp_file: engine.minify_file(file, temp_file)):
+			return False
+		
+		self.__precompress(output_file)
+		self.__fingerprint(file, output_file)
+		return True
+	
+	def __refine_file(self, file):
+		"""
+		Refine a single file, the refined output is written to a temporary file and renamed over the output if it's smaller.
+		
+		The file reaches the refined tier if the refine tool ran (whether its output was smaller or not) or if there is
+		nothing to refine it with, a failed refine is tried again by the next run.
+		"""
+		
+		output_file = self.__get_output_file_name(file)
+		extension = file.split('.')[-1]
+		
+		if extension in FILE_EXTENSIONS['img']:
+			tool = {'jpg': 'jpegoptim', 'jpeg': 'jpegoptim', 'png': 'optipng', 'gif': 'gifsicle'}[extension]
+			(args, function) = (self.refine_image_args[tool], lambda input_file, refined_file: self.__compress_image(tool, args, input_file, refined_file))
+			skip = tool == 'gifsicle' and not os.path.exists(GIFSICLE_PATH)
+		else:
+			type = 'css' if extension in FILE_EXTENSIONS['css'] else 'js'
+			(engine, regular_engine) = (self.refine_engines[type], self.__get_engine(type, os.path.getsize(file)))
+			(tool, args, function) = (engine.tool, engine.args, engine.minify_file)
+			skip = (engine.tool, engine.args) == (regular_engine.tool, regular_engine.args)
+		
+		refined = skip
+		if not skip and os.path.exists(output_file):
+			(fd, refined_file) = tempfile.mkstemp(prefix = '.refine-', suffix = '.' + extension, dir = os.path.dirname(output_file))
+			os.close(fd)
+			
+			try:
+				refined = self.__run_cached(tool, args, file, refined_file, lambda temp_file: function(file, temp_file))
+				
+				(size, refined_size) = (os.path.getsize(output_file), os.path.getsize(refined_file))
+				if refined and 0 < refined_size < size:
+					shutil.copymode(output_file, refined_file)
+					os.rename(refined_file, output_file)
+					
+					with self.stats_lock:
+						self.refined_count += 1
+						self.refined_size_saved += size - refined_size
+					
+					self.__precompress(output_file)
+					self.__fingerprint(file, output_file)
+			finally:
+				if os.path.exists(refined_file):
+					os.remove(refined_file)
+		
+		if refined:
+			with self.stats_lock:
+				self.file_history.setdefault(file, {'tier': TIER_FAST, 'savings': None, 'duration': None})['tier'] = TIER_REFINED
+	
+	def __compress_inline_block(self, type, code):
+		""" Compress a block of inline code and return the compressed code. """
+		
+		engine = self.__get_engine(type, len(code))
+		key = self.__get_cache_key(engine.tool, engine.args, hashlib.sha1(code).hexdigest()) if self.cache else None
+		output = self.cache.get_data(key) if key else None
+		
+		if output is None:
+			try:
+				output = engine.minify(code)
+			except ToolError, e:
+				logging.error('Inline %(type)s block: %(error)s, the block is left as it is' % {'type': type, 'error': e})
+				return None
+			
+			if key and output:
+				self.cache.put_data(key, output)
+				
+		return output
+	
+	def __get_engine(self, type, size):
+		""" Return the minifier engine used for the code of the given type and size. """
+		
+		for (max_size, engine) in self.engines[type]:
+			if max_size is None or size <= max_size:
+				return engine
+			
+	def __compress_image_file(self, file, tool):
+		""" Compress a single image with jpegoptim (JPEG), optipng (PNG) or gifsicle (GIF), returns False if the tool failed. """
+		
+		if self.__optimize_image(file, tool) is False:
+			return False
+		
+		self.__fingerprint(file, self.__get_output_file_name(file))
+		return True
+		
+	def __optimize_image(self, file, tool):
+		output_file = self.__get_output_file_name(file)
+		args = self.image_args[tool]
+		
+		if tool == 'gifsicle' and not os.path.exists(GIFSICLE_PATH):
+			# GIF images can only be compressed with gifsicle, otherwise they are left as they are
+			if output_file != file:
+				self.__write_output(output_file, lambda temp_file: shutil.copyfile(file, temp_file))
+				
+			return
+		
+		if self.cache and self.cache.contains(self.__get_cache_key(tool + ':optimized', args, self.__get_file_hash(file))):
+			# Image is an output of a previous run, compressing it again would not make it any smaller
+			if output_file != file:
+				self.__write_output(output_file, lambda temp_file: shutil.copyfile(file, temp_file))
+				
+			with self.stats_lock:
+				self.images_already_optimized += 1
+				
+			return
+		
+		if not self.__run_cached(tool, args, file, output_file, lambda temp_file: self.__compress_image(tool, args, file, temp_file)):
+			return False
+		
+		if self.cache:
+			self.cache.put_data(self.__get_cache_key(tool + ':optimized', args, self.__get_file_hash(output_file)), '')
+		
+	def __compress_image(self, tool, args, file, output_file):
+		# Image is copied to the output file (a new temporary file), which is then compressed in place
+		shutil.copyfile(file, output_file)
+		
+		if tool == 'jpegoptim':
+			command = [JPEGOPTIM_PATH] + args + [output_file]
+		elif tool == 'optipng':
+			command = [OPTIPNG_PATH] + args + [output_file]
+		else:
+			command = [GIFSICLE_PATH, '--batch'] + args + [output_file]
+			
+		start_time = time.time()
+		process = ToolProcess(command, stdout = subprocess.PIPE, stderr = subprocess.PIPE, close_fds = True)
+		process.communicate()
+		self.__add_tool_time(start_time, process.rusage)
+		
+		if process.returncode != 0:
+			raise ToolError(tool, process.returncode)
+		
+	def __fingerprint(self, file, output_file):
+		"""
+		Copy the output to the file name with the output content hash (foo.3f9a1c.min.css) and record it in the asset manifest.
+		
+		Fingerprinted files which already exist (the output hasn't changed) are left alone, the precompressed copies
+		of the output are fingerprinted too.
+		"""
+		
+		if not self.fingerprint_manifest or not os.path.exists(output_file):
+			return
+		
+		(name, extension) = os.path.splitext(file)
+		fingerprinted_file = '%s.%s%s%s' % (name, self.__get_file_hash(output_file)[:FINGERPRINT_LENGTH], self.file_name_suffix, extension)
+		
+		if not os.path.exists(fingerprinted_file):
+			for precompressed_extension in ['.gz', '.br', '']:
+				if os.path.exists(output_file + precompressed_extension):
+					# The complete file appears at once
+					shutil.copyfile(output_file + precompressed_extension, fingerprinted_file + precompressed_extension + '.tmp')
+					os.rename(fingerprinted_file + precompressed_extension + '.tmp', fingerprinted_file + precompressed_extension)
+		
+		with self.stats_lock:
+			self.manifest[os.path.relpath(file, self.assets_path)] = os.path.relpath(fingerprinted_file, self.assets_path)
+	
+	def __load_manifest(self):
+		""" Load the asset manifest saved by the previous run. """
+		
+		try:
+			with open(self.fingerprint_manifest, 'r') as file:
+				self.manifest = json.load(file)
+		except IOError:
+			self.manifest = {}
+		except ValueError, e:
+			logging.error('Asset manifest %(manifest)s is corrupted, it will only contain the files worked on during this run (%(error)s)' % \
+						{'manifest': self.fingerprint_manifest, 'error': e})
+			self.manifest = {}
+		
+		self.saved_manifest = dict(self.manifest)
+		self.loaded_manifest = dict(self.manifest)
+	
+	def __save_manifest(self):
+		""" Save the asset manifest (the complete file appears at once), shards only save the entries which have changed. """
+		
+		(manifest_file, manifest) = (self.fingerprint_manifest, self.manifest)
+		if self.shard:
+			manifest_file = self.__get_shard_file_name(manifest_file)
+			manifest = dict([(name, fingerprinted_name) for (name, fingerprinted_name) in self.manifest.iteritems() \
+							if self.loaded_manifest.get(name) != fingerprinted_name])
+		
+		with open(manifest_file + '.tmp', 'w') as file:
+			json.dump(manifest, file, indent = 4, sort_keys = True)
+			
+		os.rename(manifest_file + '.tmp', manifest_file)
+		self.saved_manifest = dict(self.manifest)
+	
+	def __build_fingerprinted_names(self):
+		"""
+		Build the lookup table used for rewriting the references in the templates - every path suffix (foo.css,
+		css/foo.css, ...) of the logical file names and their output names (css/foo.min.css) is mapped to the
+		fingerprinted file name, suffixes shared by multiple files are ambiguous and not rewritten.
+		"""
+		
+		self.fingerprinted_names = {}
+		for (logical_name, fingerprinted_name) in self.manifest.iteritems():
+			for name in set([logical_name, self.__get_file_name_with_suffix(logical_name)]):
+				segments = name.replace(os.sep, '/').split('/')
+				
+				for index in range(len(segments)):
+					suffix = '/'.join(segments[index:])
+					if self.fingerprinted_names.get(suffix, fingerprinted_name) != fingerprinted_name:
+						self.fingerprinted_names[suffix] = None
+					else:
+						self.fingerprinted_names[suffix] = fingerprinted_name
+	
+	def __rewrite_reference(self, match):
+		""" Rewrite the href / src reference to the fingerprinted file name (the longest matching path suffix is used). """
+		
+		url = match.group(2)
+		if '://' in url or url.startswith('//'):
+			return match.group(0)
+		
+		segments = url.split('/')
+		for index in range(len(segments)):
+			fingerprinted_name = self.fingerprinted_names.get('/'.join(segments[index:]))
+			if fingerprinted_name:
+				return match.group(1) + '/'.join(segments[:-1] + [os.path.basename(fingerprinted_name)])
+			
+		return match.group(0)
+	
+	def __add_all_templates(self, actions):
+		""" Fingerprinted names have changed, so the references are rewritten in all the templates (not only in the modified ones). """
 		
-		self.end_time = time.time()
+		types = [type for (key, type) in [('minify_inline_css', 'css'), ('compile_inline_js', 'js')] if key in self.actions]
+		if not types:
+			return
 		
-		# If the --save-state option is provided, save the modification dates
-		# for all the input files which were modified
-		if self.save_state_file:
-			
-			input_files = [actions[key]['input_files'] for key in actions.keys() \
-						if actions[key]['input_files'] != None]
-
-			if input_files:
-				input_files = sum(input_files, [])
-				input_files = dict([(file, os.path.getmtime(file)) for file in input_files])
-				self.__save_state_file(input_files)
-
-		if self.print_statistics:
-			self.print_stats()
+		key = 'minify_inline_css' if 'minify_inline_css' in self.actions else 'compile_inline_js'
+		actions[key]['args'] = types
+		actions[key]['input_files'] = sorted(set(sum([self.index.get_files_with_inline_code(type) for type in types], [])))
 		
-	def minify_css(self, css_files):
-		""" Minify CSS files. """
+		if key == 'minify_inline_css' and 'compile_inline_js' in self.actions:
+			actions['compile_inline_js']['input_files'] = None
+	
+	def __precompress(self, file):
+		"""
+		Write a gzip compressed (and brotli compressed, if the brotli module is available) copy of the file
+		next to it, unless the compressed copy is not smaller than the file.
+		"""
 		
-		if not css_files:
+		if not self.precompress or not os.path.exists(file):
 			return
 		
-		logging.info('CSS minification: start')
-		self.size_before['css'] = self.__calculate_files_size(css_files)
-		self.files_count += len(css_files)
-
-		for file in css_files:
-			if self.overwrite_original:
-				output_file = file
-			else:
-				output_file = self.__get_file_name_with_suffix(file)
-			
-			subprocess.Popen('%(java_path)s -jar %(yui_compressor_path)s --type css "%(input_file)s" -o "%(output_file)s"' % {'java_path': JAVA_PATH, 'yui_compressor_path': YUI_COMPRESSOR_PATH, 'input_file': file, 'output_file': output_file}, shell = True, stdout = subprocess.PIPE, close_fds = True).communicate()[0]
+		size = os.path.getsize(file)
+		compressors = [('gz', self.__gzip)] + ([('br', self.__brotli)] if brotli else [])
 		
-		if self.overwrite_original:
-			self.size_after['css'] = self.__calculate_files_size(css_files)
-		else:
-			self.size_after['css'] = self.__calculate_files_size(map(self.__get_file_name_with_suffix, css_files))
-
-		logging.info('CSS minification: completed')
+		# The file is compressed in chunks and the compressed copy is streamed to a temporary file
+		for (extension, compress) in compressors:
+			output_file = file + '.' + extension
+			
+			with open(file, 'rb') as f:
+				with open(output_file + '.tmp', 'wb') as output:
+					for compressed_chunk in compress(iter(lambda: f.read(STREAM_CHUNK_SIZE), '')):
+						output.write(compressed_chunk)
+			
+			compressed_size = os.path.getsize(output_file + '.tmp')
+			if compressed_size < size:
+				os.rename(output_file + '.tmp', output_file)
 				
-	def compile_javascript(self, javascript_files):
-		""" Compile JavaScript files with Google Closure Compiler. """
+				with self.stats_lock:
+					self.precompressed_size_before[extension] += size
+					self.precompressed_size_after[extension] += compressed_size
+			else:
+				os.remove(output_file + '.tmp')
+				
+				# Compressed copy from a previous run is not valid anymore
+				if os.path.exists(output_file):
+					os.remove(output_file)
+				
+	def __gzip(self, chunks):
+		""" Compress the chunks of data in the gzip format (with the maximum compression level and without a timestamp). """
 		
-		if not javascript_files:
-			return
+		compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+		(crc, size) = (0, 0)
 		
-		logging.info('JavaScript compilation: start')
-		self.size_before['js'] = self.__calculate_files_size(javascript_files)
+		yield '\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff'
+		for chunk in chunks:
+			crc = zlib.crc32(chunk, crc)
+			size += len(chunk)
+			yield compressor.compress(chunk)
+			
+		yield compressor.flush() + struct.pack('<II', crc & 0xffffffff, size & 0xffffffff)
+	
+	def __brotli(self, chunks):
+		""" Compress the chunks of data in the brotli format (the old brotli modules can only compress the whole data at once). """
 		
-		for file in javascript_files:
-			if self.overwrite_original:
-				output = subprocess.Popen('%(java_path)s -jar %(closure_compiler_path)s --compilation_level SIMPLE_OPTIMIZATIONS --warning_level QUIET --js "%(input_file)s"' % {'java_path': JAVA_PATH, 'closure_compiler_path': CLOSURE_COMPILER_PATH, 'input_file': file}, shell = True, stdout = subprocess.PIPE, close_fds = True).communicate()[0]
+		if not hasattr(brotli, 'Compressor'):
+			yield brotli.compress(''.join(chunks), quality = 11)
+			return
+		
+		compressor = brotli.Compressor(quality = 11)
+		for chunk in chunks:
+			yield compressor.process(chunk)
 			
-				with open(file, 'w+') as f:
-					f.truncate(0)		
-					f.seek(0)
-					f.write(output)
-			else:
-				subprocess.Popen('%(java_path)s -jar %(closure_compiler_path)s --compilation_level SIMPLE_OPTIMIZATIONS --warning_level QUIET --js "%(input_file)s" --js_output_file "%(output_file)s"' % {'java_path': JAVA_PATH, 'closure_compiler_path': CLOSURE_COMPILER_PATH, 'input_file': file, 'output_file': self.__get_file_name_with_suffix(file)}, shell = True, stdout = subprocess.PIPE, close_fds = True).communicate()[0]
+		yield compressor.finish()
+	
+	def __run_cached(self, tool, args, input_file, output_file, function):
+		"""
+		Call the function which writes the tool output to the provided file, unless the output for the same
+		input content, tool, tool version and tool arguments is already in the output cache.
 		
-		if self.overwrite_original:
-			self.size_after['js'] = self.__calculate_files_size(javascript_files)
-		else:
-			self.size_after['js'] = self.__calculate_files_size(map(self.__get_file_name_with_suffix, javascript_files))
+		Returns True if output_file was written, False if the tool failed.
+		"""
 		
-		logging.info('JavaScript compilation: completed')
+		key = self.__get_cache_key(tool, args, self.__get_file_hash(input_file)) if self.cache else None
+		if key and self.cache.get(key, output_file):
+			return True
 		
-	def compress_inline_code(self, type, files):
-		""" Compress inline CSS or JavaScript code. """
+		return self.__write_output(output_file, function, key)
 		
-		if not files or type not in ['css', 'js']:
-			return
+	def __write_output(self, output_file, function, key = None):
+		"""
+		Call the function which writes the output to a new temporary file, store it in the output cache (under the key)
+		and rename it over output_file.
 		
-		# If both compress actions are selected (inline CSS minification and JavaScript compilation), we need to wait for the first
-		# one to finish, because they could both work on the same files.
-		if 'minify_inline_css' in self.actions and 'compile_inline_js' in self.actions:
-			self.lock.acquire()
-			if self.inline_running == True:
-				self.lock.release()
-				self.event.wait()
-			else:
-				self.lock.release()
-				
-			self.lock.acquire()
-			self.inline_running = True
-			self.lock.release()
+		Outputs are never modified in place (they can be hard links to the cache entries) and if the tool fails, the
+		previous output is left alone and nothing is cached. Returns True if output_file was written, False otherwise.
+		"""
+		
+		(fd, temp_file) = tempfile.mkstemp(prefix = '.asset_deflator', suffix = os.path.splitext(output_file)[1], dir = os.path.dirname(os.path.abspath(output_file)))
+		os.close(fd)
+		
+		try:
+			function(temp_file)
+			os.chmod(temp_file, self.file_mode)
 			
-			# If users has selected not to overwrite the original files and this is a second run, we must use already compressed files
-			if not self.overwrite_original and self.inline_run_count == 1:
-				files = map(self.__get_file_name_with_suffix, files)
-
-		logging.info('Inline %(type)s compression: start' % {'type': 'CSS' if type == 'css' else 'JavaScript'})
-		self.size_before['tpl'] = self.__calculate_files_size(files)
-		self.files_count += len(files)
-		
-		# Copy the template files to a temporary directory
-		original_file_locations = []
-		for index, file in enumerate(files):
-			# Index is prepended to the file name, because files can be located in different directories and have the same name
-			shutil.copy(file, os.path.join(self.temporaryDirectories[type + '_files'], str(index) + '.' + os.path.basename(file)))
-			original_file_locations.append(os.path.dirname(file))
-		
-		# Find inline code, extract it and write it to a temporary file
-		matching_files = {}
-		for file in os.listdir(self.temporaryDirectories[type + '_files']):
-			with open(os.path.join(self.temporaryDirectories[type + '_files'], file), 'r') as f:
-				content = f.read()
-				matches = self.css_re.findall(content) if type == 'css' else self.javascript_re.findall(content)
-				
-				if len(matches) > 0:
-					matching_files[file] = []
-						
-				for match in matches:
-					tmp_file = tempfile.NamedTemporaryFile(delete = False)
-					tmp_file.write(match)
-					tmp_file.close()
-
-					matching_files[file].append(tmp_file.name)
-					self.temporaryFiles.append(tmp_file.name)
-		
-		# Compress the temporary and save the compressed code to a temporary file named <temp_name>.min.extension
-		for key, temp_files in matching_files.iteritems():
-			for file in temp_files:
-				if type == 'css':
-					output = subprocess.Popen('%(java_path)s -jar %(yui_compressor_path)s --type css "%(input_file)s"' % {'java_path': JAVA_PATH, 'yui_compressor_path': YUI_COMPRESSOR_PATH, 'input_file': file}, shell = True, stdout = subprocess.PIPE, close_fds = True).communicate()[0]
-				elif type == 'js':
-					output = subprocess.Popen('%(java_path)s -jar %(closure_compiler_path)s --compilation_level SIMPLE_OPTIMIZATIONS --warning_level QUIET --js "%(input_file)s"' % {'java_path': JAVA_PATH, 'closure_compiler_path': CLOSURE_COMPILER_PATH, 'input_file': file}, shell = True, stdout = subprocess.PIPE, close_fds = True).communicate()[0]
-			 
-				with open(file + self.file_name_suffix, 'w+') as f:
-					f.write(output)
-					  
-		# Open the template files with blocks of inline code and replace the non-compressed code with the compressed one
-		for index, file in enumerate(os.listdir(self.temporaryDirectories[type + '_files'])):
-			
-			file_path = os.path.join(self.temporaryDirectories[type + '_files'], file)
-			with open(file_path, 'r+') as f_tpl:
-				content = f_tpl.read()
-				
-				for matching_file in matching_files[file]:
-					with open(matching_file, 'r') as f:
-						original_code = f.read()
-						
-					with open(matching_file + self.file_name_suffix, 'r') as f:
-						compressed_code = f.read()
-						
-					content = re.sub('%(original_code)s' % {'original_code': re.escape(original_code)}, compressed_code, content, 1)
-					
-				f_tpl.truncate(0)		
-				f_tpl.seek(0)
-				f_tpl.write(content)
+			if key:
+				self.cache.put(key, temp_file)
 				
-			# Remove index from the file name, (optionally) add a suffix and move file back to the original location
-			file_path = self.__remove_index_from_file_name(file_path)
-			
-			if not self.overwrite_original and self.inline_run_count == 0:
-				file_path = self.__add_suffix_after_file_name(file_path)
+			os.rename(temp_file, output_file)
+		except ToolError, e:
+			logging.error('%(file)s: %(error)s, the output was not updated' % {'file': output_file, 'error': e})
+			return False
+		finally:
+			if os.path.exists(temp_file):
+				os.remove(temp_file)
 				
-			self.__move_file(file_path, original_file_locations[index])
- 
-		if self.overwrite_original:
-			self.size_after['tpl'] = self.__calculate_files_size(files)
-		else:
-			self.size_after['tpl'] = self.__calculate_files_size(map(self.__get_file_name_with_suffix, files))
+		return True
+			
+	def __get_cache_key(self, tool, args, input_hash):
+		""" Return the output cache key for the input hash and the tool (and its arguments). """
 		
-		if 'minify_inline_css' in self.actions and 'compile_inline_js' in self.actions:  
-			# Signal the waiting thread that we are done  
-			self.lock.acquire()
-			self.inline_running = False
-			self.inline_run_count = 1
-			self.event.set()
-			self.event.clear()
-			self.lock.release()
-
-		logging.info('Inline %(type)s compression: completed' % {'type': 'CSS' if type == 'css' else 'JavaScript'})
+		return self.cache.get_key(input_hash, tool, self.__get_tool_version(tool.split(':')[0]), args)
 		
-	def compress_images(self, image_files):
-		""" Compress images using jpegoptim / optipng tool. """
+	def __get_tool_version(self, tool):
+		""" Return the tool version (hash of the tool jar / binary, which changes with every tool release). """
 		
-		if not image_files:
-			return
+		with self.stats_lock:
+			if tool not in self.tool_versions:
+				tool_path = {'yui': YUI_COMPRESSOR_PATH, 'closure': CLOSURE_COMPILER_PATH, 'jpegoptim': JPEGOPTIM_PATH, \
+							'optipng': OPTIPNG_PATH, 'gifsicle': GIFSICLE_PATH}[tool]
+				self.tool_versions[tool] = self.__get_file_hash(tool_path) if os.path.exists(tool_path) else ''
 		
-		logging.info('Image compression: start')
-		self.size_before['img'] = self.__calculate_files_size(image_files)
-		self.files_count += len(image_files)
-
-		jpg_image_files = filter(lambda file: True if file.split('.')[-1] in ['jpg', 'jpeg'] else False, image_files)
-		png_image_files = filter(lambda file: True if file.split('.')[-1] in ['png', 'gif'] else False, image_files)	
+			return self.tool_versions[tool]
+	
+	def __get_file_hash(self, file_name):
+		""" Return the SHA1 hash of the file content. """
 		
-		if self.overwrite_original:
-			destination = ''
-		else:
-			destination = '--dest="%(temp_directory)s"' % {'temp_directory': self.temporaryDirectories['jpg_files']}
-
-		for file in jpg_image_files:
-			subprocess.Popen('%(jpegoptim_path)s --strip-all %(destination)s "%(input_file)s"' % {'jpegoptim_path': JPEGOPTIM_PATH, 'destination': destination, 'input_file': file}, shell = True, stdout = subprocess.PIPE).communicate()[0]
- 
-			compressed_file_path = os.path.join(self.temporaryDirectories['jpg_files'], os.path.basename(file))
-			if not self.overwrite_original and os.path.exists(compressed_file_path):
-				# Add a suffix to the file name and move it back to the original location 
-				new_name = self.__add_suffix_after_file_name(compressed_file_path)
-				self.__move_file(new_name, os.path.dirname(file))
+		file_hash = hashlib.sha1()
+		with open(file_name, 'rb') as file:
+			for chunk in iter(lambda: file.read(STREAM_CHUNK_SIZE), ''):
+				file_hash.update(chunk)
+				
+		return file_hash.hexdigest()
+	
+	def __add_files_count(self, count):
+		""" Add to the number of files which were worked on. """
 		
-		for file in png_image_files:
-			if self.overwrite_original:
-				output_file = file
-			else:
-				output_file = self.__get_file_name_with_suffix(file)
+		with self.stats_lock:
+			self.files_count += count
+	
+	def __run_java(self, tool, args, input_data = None):
+		"""
+		Run YUI compressor or Closure compiler with the provided arguments and return its output, raise ToolError
+		if the tool exits with a non-zero status.
+		
+		If the Java worker pool is running, the command is executed in one of the pool JVMs, otherwise
+		(or if the pool JVM fails) a new JVM is started.
+		"""
+		
+		if self.java_pool:
+			start_time = time.time()
+			try:
+				(status, output) = self.java_pool.run(JAVA_MAIN_CLASSES[tool], args, input_data)
+				if status != 0:
+					raise ToolError(tool, status)
+				
+				return output
+			except (socket.error, struct.error), e:
+				logging.error('Java worker pool: command failed (%(error)s), falling back to a new JVM' % {'error': e})
+			finally:
+				# CPU time of the commands run in the pool JVMs is not known
+				self.__add_tool_time(start_time)
 				
-			subprocess.Popen('%(optipng_path)s "%(input_file)s" -out "%(output_file)s"' % {'optipng_path': OPTIPNG_PATH, 'input_file': file, 'output_file': output_file}, shell = True, stdout = subprocess.PIPE).communicate()[0]
+		start_time = time.time()
+		jar_path = YUI_COMPRESSOR_PATH if tool == 'yui' else CLOSURE_COMPILER_PATH
+		process = ToolProcess([JAVA_PATH, '-Xmx%dm' % (self.java_heap_size), '-jar', jar_path] + args, stdin = subprocess.PIPE if input_data is not None else None, \
+							stdout = subprocess.PIPE, close_fds = True)
 		
-		if self.overwrite_original:
-			self.size_after['img'] = self.__calculate_files_size(image_files)
-		else:
-			self.size_after['img'] = self.__calculate_files_size(map(self.__get_file_name_with_suffix, image_files))
+		output = process.communicate(input_data)[0]
+		self.__add_tool_time(start_time, process.rusage)
 		
-		logging.info('Image compression: completed')
+		if process.returncode != 0:
+			raise ToolError(tool, process.returncode)
 		
-	def __calculate_files_size(self, files):
-		""" Calculate the size of the files in the list. """
+		return output
 		
-		return reduce(operator.add, map(lambda file: os.path.getsize(file) if os.path.exists(file) else 0, files))
+	def __start_java_pool(self):
+		""" Start the Java worker pool (if enabled and Nailgun is available). """
 		
-	def __find_files_with_inline_code(self, regular_expression, files):
-		""" Return a list of files which contain text matching the provided regular expression. """
+		if self.java_workers < 1 or not os.path.exists(NAILGUN_PATH):
+			return
 		
-		matching_files = []
-		for file in files:
-			with open(file, 'r') as f:
-				content = f.read()
-				matches = regular_expression.findall(content)
-				
-				if len(matches) > 0:
-					matching_files.append(file)
-					
-		return matching_files
+		pool = JavaWorkerPool(self.java_workers, [NAILGUN_PATH, YUI_COMPRESSOR_PATH, CLOSURE_COMPILER_PATH], self.java_heap_size)
+		if pool.start():
+			self.java_pool = pool
+			atexit.register(self.__stop_java_pool)
+		else:
+			logging.error('Java worker pool: could not be started, starting a new JVM for every file')
 	
-	def __find_valid_files(self, path, valid_extensions):
-		""" Return a list of files with a valid extension. """
-
-		valid_files = []
-		for dir_path, dir_name, file_names in os.walk(path):
-			for file in file_names:
-				extension = file.split('.')[-1]
-				
-				# Skip the files with .min suffix so we don't do stuff with already minified / compressed files
-				if extension in valid_extensions and file.find(self.file_name_suffix) == -1:
-					valid_files.append(os.path.join(dir_path, file))
-
-		return valid_files
+	def __stop_java_pool(self):
+		""" Stop the Java worker pool. """
+		
+		if self.java_pool:
+			self.java_pool.stop()
+			logging.info('Java worker pool: avoided %(count)d JVM launches' % {'count': self.java_pool.launches_avoided})
 	
-	def __move_file(self, path, destination):
-		""" Move a file or multiple files to a destination directory. """
-
-		if os.path.isdir(path):
-			for dir_path, dir_names, file_names in os.walk(path):
-				for file in file_names:
-					file_path = os.path.join(dir_path, file)
-					shutil.move(file_path, os.path.join(destination, os.path.basename(file_path)))
-		else:
-			shutil.move(path, os.path.join(destination, os.path.basename(path)))
+	def __remove_nested_spans(self, spans):
+		""" Sort the (start, end, type) spans and remove the ones which overlap with a preceding span (e.g. CSS inside a JavaScript string). """
+		
+		result = []
+		for span in sorted(spans):
+			if not result or span[0] >= result[-1][1]:
+				result.append(span)
+				
+		return result
 	
-	def __add_suffix_after_file_name(self, path):
-		""" Add a defined suffix after the file name before the file extension. """
+	def __calculate_files_size(self, files):
+		""" Calculate the size of the files in the list. """
 		
-		if os.path.isdir(path):
-			for dir_path, dir_names, files in os.walk(path):
-				for file in files:
-					file_path = os.path.join(dir_path, file)  
-					
-					new_file_name = self.__get_file_name_with_suffix(file_path)
-					shutil.move(file_path, new_file_name)
-		else:
-			new_file_name = self.__get_file_name_with_suffix(path)	  
-			shutil.move(path, new_file_name)
-			
-			return new_file_name
+		return reduce(operator.add, map(lambda file: os.path.getsize(file) if os.path.exists(file) else 0, files))
 		
-	def __remove_index_from_file_name(self, path):
-		""" Remove index from the beginning of the file name. """
+	def __get_output_file_name(self, file_name):
+		""" Return the name of the file where the output for the provided file is saved. """
 		
-		new_file_name = path[path.find('.') + 1:]
-		shutil.move(path, new_file_name)	
+		if self.overwrite_original:
+			return file_name
 		
-		return new_file_name
-			
+		return self.__get_file_name_with_suffix(file_name)
+	
 	def __get_file_name_with_suffix(self, file_name):
 		""" Return file name with added suffix. """
 		
@@ -432,28 +3200,6 @@ class AssetDeflator():
 			
 		return new_name 
 	
-	def __create_temporary_directories(self):
-		""" Create temporary directories. """
-		
-		self.temporaryDirectories = {}
-		self.temporaryFiles = []
-		
-		self.temporaryDirectories['css_files'] = tempfile.mkdtemp()
-		self.temporaryDirectories['js_files'] = tempfile.mkdtemp()
-		self.temporaryDirectories['jpg_files'] = tempfile.mkdtemp()
-		self.temporaryDirectories['png_files'] = tempfile.mkdtemp()
-		
-	def __cleanup_tempporary_files(self):
-		""" Delete all temporary directories and files. """
-		
-		for key, directory in self.temporaryDirectories.iteritems():
-			if os.path.exists(directory):
-				shutil.rmtree(directory, ignore_errors = True)
-			
-		for file in self.temporaryFiles:
-			if os.path.exists(file):
-				os.remove(file)
-				
 	def __lock(self):
 		""" Create a lock file. """
 
@@ -466,32 +3212,47 @@ class AssetDeflator():
 		if os.path.exists(self.lock_file):
 			os.unlink(self.lock_file)
 			
-	def __read_state_file(self):
-		"""
-		Reads file paths and modification times from the state file
-		and returns a dictionary (file_path: modification_time) on
-		success, None otherwise.
-		"""
+	def __get_build_database(self, path):
+		""" Return the (already opened) build database stored in the state file. """
 		
-		try:
-			with open(self.state_file, 'r') as file:
-				return pickle.load(file)
-		except Exception, e:
-			return None
-
-	def __save_state_file(self, files = None):
-		""" Saves the state to a file. """
+		if path not in self.build_databases:
+			self.build_databases[path] = BuildDatabase(path)
+			
+		return self.build_databases[path]
+	
+	def __close_build_databases(self):
+		""" Close the build databases (they are opened again by the next run). """
 		
-		current_state = self.__read_state_file()
-		with open(self.save_state_file, 'w+') as file:
-			if current_state:
-				# If previous state is available, update it
-				current_state.update(files)
-				new_state = current_state
-			else:
-				new_state = files	
-
-			pickle.dump(new_state, file)
+		for database in self.build_databases.values():
+			database.close()
+			
+		self.build_databases = {}
+	
+	def __save_state_file(self, rows):
+		""" Saves the rows of the files which were worked on to the state file. """
+		
+		database = self.__get_build_database(self.save_state_file)
+		
+		# The state is read from a different file, so it is copied over once
+		if not self.state_file_merged and self.state_file and self.state_file != self.save_state_file and os.path.exists(self.state_file) and not self.shard:
+			database.merge(self.state_file)
+			
+		self.state_file_merged = True
+		database.update(rows)
+	
+	def __state_file_error(self, path, error):
+		# Only a damaged file is worth deleting, other errors (database is locked, ...) are reported as they are
+		if isinstance(error, sqlite3.DatabaseError) and re.search(r'file is not a database|malformed', str(error)):
+			message = 'State file %s is corrupted (%s) - delete it to start from scratch.' % (path, error)
+		else:
+			message = 'State file %s can\'t be used (%s: %s).' % (path, error.__class__.__name__, error)
+		
+		# Server keeps running, only the request fails
+		if self.serving:
+			raise StateFileError(message)
+		
+		print message
+		sys.exit(1)
 	
 	def print_stats(self):
 		print 'Statistics'
@@ -502,7 +3263,39 @@ class AssetDeflator():
 		else:
 			print 'Performed work on %(files_count)d files located in %(assets_path)s'  % {'files_count': self.files_count, 'assets_path': self.assets_path}
 			
+		if self.shard:
+			print 'Shard: %d of %d' % self.shard
+			
 		print 'Running time: %(running_time)s' % {'running_time': str(datetime.timedelta(seconds = int(self.end_time - self.start_time)))}
+		print 'Phase times: %(phase_times)s' % {'phase_times': ', '.join(['%s %.2fs' % (phase, seconds) for (phase, seconds) in sorted(self.phase_times.items())])}
+		
+		if self.java_pool:
+			print 'JVM launches avoided: %(count)d' % {'count': self.java_pool.launches_avoided}
+			
+		if self.admission and self.admission.changes:
+			print 'Jobs at once: up to %(max_jobs)d, lowest limit %(lowest)d (limit changed %(count)d times)' % {'max_jobs': self.admission.max_jobs, \
+					'lowest': min([change['limit'] for change in self.admission.changes]), 'count': len(self.admission.changes)}
+			
+		if self.cache:
+			print 'Output cache hits: %(hits)d, misses: %(misses)d' % {'hits': self.cache.hits, 'misses': self.cache.misses}
+			
+		if self.images_already_optimized:
+			print 'Already optimized images (skipped): %(count)d' % {'count': self.images_already_optimized}
+			
+		if self.unprofitable_count:
+			print 'Unprofitable files (skipped, saved less than %(min_savings)g%%): %(count)d' % {'min_savings': self.min_savings * 100, 'count': self.unprofitable_count}
+			
+		if self.refined_count:
+			print 'Refined outputs: %(count)d, saved %(size)d bytes' % {'count': self.refined_count, 'size': self.refined_size_saved}
+		
+		if self.failed_files:
+			print 'Failed files (worked on again by the next run): %(count)d' % {'count': len(self.failed_files)}
+		
+		if self.report_file and self.tasks:
+			print ''
+			print 'Slowest tasks:'
+			for task in self.__get_slowest_tasks():
+				print '%(wall_time).2fs (tool %(tool_time).2fs, queued %(queue_wait).2fs) %(action)s %(name)s' % task
 		
 		if 'minify_css' in self.actions and self.size_before['css'] > 0:
 			print ''
@@ -519,23 +3312,335 @@ class AssetDeflator():
 			print 'Templates:'
 			print 'Size before: %(size_before)d bytes, Size after: %(size_after)d bytes %(difference)+.2f%%' % {'size_before': self.size_before['tpl'], 'size_after': self.size_after['tpl'], 'difference': operator.neg((100 - (float(self.size_after['tpl']) / self.size_before['tpl'] * 100)))}
 			
+		if 'build_bundles' in self.actions and self.size_before['bundle'] > 0:
+			print ''
+			print 'Bundles:'
+			print 'Size before: %(size_before)d bytes, size after: %(size_after)d bytes %(difference)+.2f%%' % {'size_before': self.size_before['bundle'], 'size_after': self.size_after['bundle'], 'difference': operator.neg((100 - (float(self.size_after['bundle']) / self.size_before['bundle'] * 100)))}
+			
 		if 'compress_imgs' in self.actions and self.size_before['img'] > 0:
 			print ''
 			print 'Image files:'
 			print 'Size before: %(size_before)d bytes, size after: %(size_after)d bytes %(difference)+.2f%%' % {'size_before': self.size_before['img'], 'size_after': self.size_after['img'], 'difference': operator.neg((100 - (float(self.size_after['img']) / self.size_before['img'] * 100)))}
 
+		for (extension, description) in [('gz', 'Gzip'), ('br', 'Brotli')]:
+			if self.precompressed_size_before[extension] > 0:
+				print ''
+				print '%(description)s compressed copies:' % {'description': description}
+				print 'Size before: %(size_before)d bytes, size after: %(size_after)d bytes %(difference)+.2f%%' % {'size_before': self.precompressed_size_before[extension], 'size_after': self.precompressed_size_after[extension], 'difference': operator.neg((100 - (float(self.precompressed_size_after[extension]) / self.precompressed_size_before[extension] * 100)))}
+		
 		if self.files_count > 0:
 			print ''
 			print 'Total:'
 			print 'Size before: %(size_before)d bytes, size after: %(size_after)d bytes %(difference)+.2f%%' % {'size_before': reduce(operator.add, self.size_before.values()), 'size_after': reduce(operator.add, self.size_after.values()), 'difference': operator.neg((100 - (float(reduce(operator.add, self.size_after.values())) / reduce(operator.add, self.size_before.values()) * 100)))}
 
+class DeflatorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+	Handler of the Asset Deflator server (--serve) requests:
+	
+	- POST /minify/css, POST /minify/js - minify the code in the request body and return it
+	- POST /deflate?path=PATH - run the actions on the files under the path and return the statistics (JSON)
+	- GET /stats - return the cache and the Java worker pool statistics (JSON)
+	"""
+	
+	server_version = 'AssetDeflator/' + __version__
+	
+	def do_GET(self):
+		if urlparse.urlparse(self.path)[2] != '/stats':
+			return self.__respond(404, 'Not found\n')
+		
+		asset_deflator = self.server.asset_deflator
+		stats = {'result_cache': {'entries': len(asset_deflator.result_cache.entries), 'size': asset_deflator.result_cache.size, \
+								'hits': asset_deflator.result_cache.hits, 'misses': asset_deflator.result_cache.misses}}
+		if asset_deflator.cache:
+			stats['output_cache'] = {'hits': asset_deflator.cache.hits, 'misses': asset_deflator.cache.misses}
+		
+		if asset_deflator.java_pool:
+			stats['java_pool'] = {'launches_avoided': asset_deflator.java_pool.launches_avoided}
+		
+		self.__respond(200, json.dumps(stats), 'application/json')
+		
+	def do_POST(self):
+		url = urlparse.urlparse(self.path)
+		query = urlparse.parse_qs(url[4])
+		body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+		
+		try:
+			if url[2] in ('/minify/css', '/minify/js'):
+				type = url[2].split('/')[-1]
+				(output, cached) = self.server.asset_deflator.minify(type, body)
+				
+				# Tool failed (or returned nothing for a non-empty input)
+				if not output and body.strip():
+					return self.__respond(500, 'Minification failed\n')
+				
+				self.__respond(200, output, 'text/css' if type == 'css' else 'application/javascript', {'X-Cache': 'hit' if cached else 'miss'})
+			elif url[2] == '/deflate':
+				if 'path' not in query:
+					raise ValueError('Missing path parameter')
+				
+				self.__respond(200, json.dumps(self.server.asset_deflator.deflate(query['path'][0])), 'application/json')
+			else:
+				self.__respond(404, 'Not found\n')
+		except ValueError, e:
+			self.__respond(400, '%s\n' % (e))
+		except Exception, e:
+			logging.exception('Server: request %(path)s failed' % {'path': self.path})
+			self.__respond(500, '%s\n' % (e))
+	
+	def address_string(self):
+		# Clients connected over a Unix socket have no address
+		return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix socket'
+	
+	def log_message(self, format, *args):
+		logging.info('Server: %(address)s %(message)s' % {'address': self.address_string(), 'message': format % args})
+		
+	def __respond(self, code, body, content_type = 'text/plain', headers = {}):
+		self.send_response(code)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		for (name, value) in headers.iteritems():
+			self.send_header(name, value)
+			
+		self.end_headers()
+		self.wfile.write(body)
+
+class HTTPDeflatorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class UnixDeflatorServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+class Benchmark():
+	"""
+	Benchmark of the whole run on a synthetic asset corpus.
+	
+	External tools are replaced by stub executables which sleep for the configured latency and do a trivial
+	minification, so the benchmark measures the work done by this script (discovery, scheduling, inline code
+	rewriting, state file handling) without Java or the real tools. Every run works on a fresh copy of the
+	corpus and is followed by an incremental run (nothing has changed, all files are skipped).
+	"""
+	
+	stub_script = '''#!%(python)s
+import os, re, sys, time
+
+time.sleep(%(latency)f)
+if os.path.basename(sys.argv[0]) != 'java':
+	# Image tools optimize the file in place
+	sys.exit(0)
+
+(input_files, output_file) = ([], None)
+args = iter([arg for arg in sys.argv[1:] if not arg.startswith('-X')][2:])
+for arg in args:
+	if arg in ('--js', ):
+		input_files.append(next(args))
+	elif arg in ('-o', '--js_output_file'):
+		output_file = next(args)
+	elif arg in ('--type', '--compilation_level', '--warning_level', '--charset', '--line-break'):
+		next(args)
+	elif arg.startswith('-'):
+		# Unknown flags (without a value) don't change the stub output
+		continue
+	else:
+		input_files.append(arg)
+
+code = ''.join([open(file).read() for file in input_files]) if input_files else sys.stdin.read()
+output = re.sub(r'\\s+', ' ', code).strip()
+if output_file:
+	open(output_file, 'w').write(output)
+else:
+	sys.stdout.write(output)
+'''
+	
+	def __init__(self, css_count = 200, js_count = 200, template_count = 100, image_count = 100, inline_blocks = 4, \
+				latency = 0.05, runs = 3, **deflator_options):
+		self.corpus = {'css': css_count, 'js': js_count, 'templates': template_count, 'images': image_count, 'inline_blocks': inline_blocks}
+		self.latency = latency
+		self.runs = runs
+		self.deflator_options = deflator_options
+		self.random = random.Random(0)
+		
+	def run(self):
+		""" Run the benchmark and return the results (timings are medians of all the runs). """
+		
+		directory = tempfile.mkdtemp(prefix = 'asset_deflator_benchmark_')
+		tool_paths = dict([(name, globals()[name]) for name in ('JAVA_PATH', 'YUI_COMPRESSOR_PATH', 'CLOSURE_COMPILER_PATH', \
+							'JPEGOPTIM_PATH', 'OPTIPNG_PATH', 'GIFSICLE_PATH', 'NAILGUN_PATH')])
+		
+		try:
+			globals().update(self.__create_stubs(os.path.join(directory, 'stubs')))
+			corpus_path = os.path.join(directory, 'corpus')
+			self.corpus['bytes'] = self.__create_corpus(corpus_path)
+			
+			samples = {'full': [], 'incremental': []}
+			for run in range(self.runs):
+				assets_path = os.path.join(directory, 'run-%d' % (run))
+				state_file = os.path.join(directory, 'run-%d.state' % (run))
+				shutil.copytree(corpus_path, assets_path)
+				
+				samples['full'].append(self.__run_deflator(assets_path, state_file))
+				samples['incremental'].append(self.__run_deflator(assets_path, state_file))
+				logging.info('Benchmark: run %(run)d of %(runs)d completed' % {'run': run + 1, 'runs': self.runs})
+		finally:
+			globals().update(tool_paths)
+			shutil.rmtree(directory, ignore_errors = True)
+		
+		return {
+			'version': __version__,
+			'python': platform.python_version(),
+			'date': datetime.datetime.now().isoformat(),
+			'corpus': self.corpus,
+			'stub_latency': self.latency,
+			'options': self.deflator_options,
+			'runs': self.runs,
+			'full': self.__get_medians(samples['full']),
+			'incremental': self.__get_medians(samples['incremental']),
+			'samples': samples
+		}
+	
+	def __run_deflator(self, assets_path, state_file):
+		""" Run all the actions on the assets path and return the total and the phase times. """
+		
+		actions = dict([(action, True) for action in ('minify_css', 'minify_inline_css', 'compile_js', 'compile_inline_js', 'compress_imgs')])
+		asset_deflator = AssetDeflator(assets_path, actions, False, False, state_file, state_file, \
+									lock_file = os.path.join(os.path.dirname(assets_path), 'benchmark.lock'), **self.deflator_options)
+		
+		start_time = time.time()
+		asset_deflator.start()
+		
+		return {'total': time.time() - start_time, 'phases': asset_deflator.phase_times}
+	
+	def __get_medians(self, samples):
+		phases = set(sum([sample['phases'].keys() for sample in samples], []))
+		
+		return {
+			'total': self.__median([sample['total'] for sample in samples]),
+			'phases': dict([(phase, self.__median([sample['phases'].get(phase, 0) for sample in samples])) for phase in phases])
+		}
+	
+	def __median(self, values):
+		values = sorted(values)
+		middle = len(values) // 2
+		
+		return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+	
+	def __create_stubs(self, path):
+		""" Create the stub tools and return the tool paths pointing to them. """
+		
+		os.makedirs(path)
+		stub_path = os.path.join(path, 'java')
+		with open(stub_path, 'w') as file:
+			file.write(self.stub_script % {'python': sys.executable, 'latency': self.latency})
+			
+		os.chmod(stub_path, 0755)
+		for name in ('jpegoptim', 'optipng', 'gifsicle'):
+			os.symlink(stub_path, os.path.join(path, name))
+		
+		for name in ('yuicompressor.jar', 'closure-compiler.jar'):
+			open(os.path.join(path, name), 'w').close()
+		
+		return {
+			'JAVA_PATH': stub_path,
+			'YUI_COMPRESSOR_PATH': os.path.join(path, 'yuicompressor.jar'),
+			'CLOSURE_COMPILER_PATH': os.path.join(path, 'closure-compiler.jar'),
+			'JPEGOPTIM_PATH': os.path.join(path, 'jpegoptim'),
+			'OPTIPNG_PATH': os.path.join(path, 'optipng'),
+			'GIFSICLE_PATH': os.path.join(path, 'gifsicle'),
+			# Java worker pool is not used
+			'NAILGUN_PATH': os.path.join(path, 'nailgun.jar')
+		}
+	
+	def __create_corpus(self, path):
+		""" Create the synthetic asset files (10 files per directory) and return their total size. """
+		
+		files = []
+		for (count, extensions, generate) in [(self.corpus['css'], ['css'], self.__generate_css), (self.corpus['js'], ['js'], self.__generate_javascript), \
+											(self.corpus['templates'], ['html'], self.__generate_template), \
+											(self.corpus['images'], ['jpg', 'png', 'gif'], self.__generate_image)]:
+			for number in range(count):
+				files.append(('%s-%d.%s' % (extensions[0] if len(extensions) == 1 else 'image', number, extensions[number % len(extensions)]), generate))
+		
+		size = 0
+		for (number, (file_name, generate)) in enumerate(files):
+			dir_path = os.path.join(path, 'dir-%d' % (number // 100), 'dir-%d' % (number // 10))
+			if not os.path.isdir(dir_path):
+				os.makedirs(dir_path)
+				
+			content = generate()
+			with open(os.path.join(dir_path, file_name), 'wb') as file:
+				file.write(content)
+				
+			size += len(content)
+			
+		return size
+	
+	def __generate_css(self, rules = None):
+		rules = rules or self.random.randint(5, 200)
+		return '\n'.join(['.class-%d  ,  #id-%d > a:hover {\n  color : #FFFFFF ;\n  margin : 0px 0px ;\n  /* comment */\n}\n' % (rule, rule) \
+						for rule in range(rules)])
+	
+	def __generate_javascript(self, functions = None):
+		functions = functions or self.random.randint(5, 200)
+		return '\n'.join(['function function_%d(argument) {\n    // comment\n    var value = argument + %d;\n    return value;\n}\n' % (function, function) \
+						for function in range(functions)])
+	
+	def __generate_template(self):
+		blocks = []
+		for block in range(self.corpus['inline_blocks']):
+			if block % 2:
+				blocks.append('<script type="text/javascript">%s</script>' % (self.__generate_javascript(self.random.randint(1, 10))))
+			else:
+				blocks.append('<style type="text/css">%s</style>' % (self.__generate_css(self.random.randint(1, 10))))
+				
+		return '<html>\n<head>\n%s\n</head>\n<body>\n%s\n</body>\n</html>\n' % ('\n'.join(blocks), '<p>content</p>\n' * self.random.randint(10, 100))
+	
+	def __generate_image(self):
+		return ''.join([chr(self.random.randint(0, 255)) for byte in range(self.random.randint(2048, 20480))])
+
 if __name__ == '__main__':	
 	parser = optparse.OptionParser(version = '%prog ' + __version__)
 	parser.add_option('-v', '--verbose', action = 'store_true', default = False, dest = 'verbose', help = 'print what is going on [default: %default]')
 	parser.add_option('-o', '--overwrite', action = 'store_true', default = False, dest = 'overwrite_original', help = 'overwrite the original files (don\'t create new files with .min extension) [default: %default]')
 	parser.add_option('-s', '--statistics', action = 'store_true', default = False, dest = 'print_statistics', help = 'print statistics at the end')
 	
-	parser.add_option('--save-state', action = 'store', type = 'string', dest = 'save_state', metavar = 'STATE_FILE', help = 'save the name and the last modified time of the files which were accessed during this run')
+	parser.add_option('-w', '--watch', action = 'store_true', default = False, dest = 'watch', help = 'keep watching the assets path after the first run and act on the changed files [default: %default]')
+	parser.add_option('--watch-interval', action = 'store', type = 'float', default = 1.0, dest = 'watch_interval', metavar = 'SECONDS', help = 'how often to check for changes if inotify is not available [default: %default]')
+	parser.add_option('--watch-debounce', action = 'store', type = 'float', default = 0.5, dest = 'watch_debounce', metavar = 'SECONDS', help = 'wait until there were no changes for this long before acting on the changed files [default: %default]')
+	parser.add_option('--serve', action = 'store', type = 'string', dest = 'serve', metavar = 'ADDRESS', help = 'keep running and answer the minify / deflate requests over HTTP (ADDRESS is host:port or port, the host must be a loopback address, localhost by default) or a Unix socket (ADDRESS is unix:/path/to/socket)')
+	parser.add_option('--serve-cache-size', action = 'store', type = 'int', default = 64, dest = 'serve_cache_size', metavar = 'MB', help = 'maximum size of the in-memory result cache used by the server [default: %default]')
+	parser.add_option('--shard', action = 'store', type = 'string', dest = 'shard', metavar = 'I/N', help = 'only work on the I-th of N slices of the files (assigned by the path hash), the state, report and manifest files are written to the partial files of the shard')
+	parser.add_option('--merge-shards', action = 'store', type = 'int', dest = 'merge_shards', metavar = 'N', help = 'merge the partial state, report and manifest files written by the N shards (use the same --save-state, --report and --fingerprint options as the shards)')
+	parser.add_option('-j', '--jobs', action = 'store', type = 'int', default = multiprocessing.cpu_count(), dest = 'jobs', metavar = 'N', help = 'maximum number of jobs (files or blocks of inline code) worked on at once, fewer jobs are worked on when the memory is low [default: %default]')
+	parser.add_option('--java-heap', action = 'store', type = 'int', default = JAVA_HEAP_SIZE, dest = 'java_heap_size', metavar = 'MB', help = 'maximum heap size of the JVMs which run YUI compressor and Closure compiler [default: %default]')
+	parser.add_option('--java-workers', action = 'store', type = 'int', default = 2, dest = 'java_workers', metavar = 'COUNT', help = 'number of long-lived JVMs used to run YUI compressor and Closure compiler (requires Nailgun, 0 disables the pool) [default: %default]')
+	
+	parser.add_option('--cache', action = 'store', type = 'string', dest = 'cache_directory', metavar = 'DIRECTORY', help = 'cache the tool outputs in the provided directory (can be shared by multiple machines) and reuse them for files with the same content')
+	parser.add_option('--cache-size', action = 'store', type = 'int', default = 1024, dest = 'cache_size', metavar = 'MB', help = 'maximum size of the output cache, the least recently used outputs are deleted first [default: %default]')
+	parser.add_option('--cache-hardlink', action = 'store_true', default = False, dest = 'cache_hard_link', help = 'hard-link the cached outputs instead of copying them (the outputs must not be edited in place afterwards) [default: %default]')
+	
+	parser.add_option('--jpeg-max-quality', action = 'store', type = 'int', dest = 'jpeg_max_quality', metavar = 'QUALITY', help = 'maximum quality (0 - 100) of the compressed JPEG images (lossy, by default only the lossless optimizations are used)')
+	parser.add_option('--png-level', action = 'store', type = 'int', dest = 'png_level', metavar = 'LEVEL', help = 'optipng optimization level (0 - 7), higher levels are slower [default: optipng default]')
+	parser.add_option('--gif-level', action = 'store', type = 'int', default = 2, dest = 'gif_level', metavar = 'LEVEL', help = 'gifsicle optimization level (1 - 3) [default: %default]')
+	
+	parser.add_option('--python-css-threshold', action = 'store', type = 'int', default = PYTHON_CSS_MINIFIER_THRESHOLD, dest = 'python_css_threshold', metavar = 'BYTES', help = 'minify the CSS files and inline CSS blocks up to this size with the built-in minifier instead of YUI compressor (0 disables it) [default: %default]')
+	
+	parser.add_option('--memory-budget', action = 'store', type = 'int', dest = 'memory_budget', metavar = 'MB', help = 'maximum total size of the files and blocks of inline code worked on at once, the other jobs wait (a larger job runs alone)')
+	parser.add_option('--min-savings', action = 'store', type = 'float', default = MIN_SAVINGS, dest = 'min_savings', metavar = 'PERCENT', help = 'don\'t work on the CSS, JavaScript and image files again (they are copied to the output) if their content hasn\'t changed and the last run saved less than this, requires --skip-not-modified (0 disables it) [default: %default]')
+	parser.add_option('--refine', action = 'store_true', default = False, dest = 'refine', help = 'after the regular run, work on the CSS, JavaScript and image files which weren\'t refined yet again with the slow settings and keep the outputs which are smaller (requires --skip-not-modified and --save-state, which keep the tier reached by every file) [default: %default]')
+	parser.add_option('--refine-advanced-js', action = 'store_true', default = False, dest = 'refine_advanced_js', help = 'refine the JavaScript files with Closure compiler advanced optimizations, which rename the symbols that are not exported (the scripts must not use each other\'s globals) [default: %default]')
+	parser.add_option('--precompress', action = 'store_true', default = False, dest = 'precompress', help = 'write gzip (and brotli, if the brotli module is installed) compressed copies of the CSS, JavaScript and template outputs next to them [default: %default]')
+	
+	parser.add_option('--report', action = 'store', type = 'string', dest = 'report_file', metavar = 'FILE', help = 'save the per phase and per task (file, block of inline code, bundle) statistics - queue wait, wall time, tool wall and CPU time, bytes in and out - as JSON (or CSV if the file name ends with .csv)')
+	parser.add_option('--report-top', action = 'store', type = 'int', default = 10, dest = 'report_top', metavar = 'N', help = 'number of the slowest tasks listed in the report summary [default: %default]')
+	parser.add_option('--profile', action = 'store', type = 'string', dest = 'profile_file', metavar = 'FILE', help = 'profile all the threads with cProfile and save the merged profile to a file (readable with the pstats module)')
+	
+	parser.add_option('--fingerprint', action = 'store', type = 'string', dest = 'fingerprint_manifest', metavar = 'MANIFEST_FILE', help = 'also write the outputs to file names with the content hash (foo.3f9a1c.min.css) and save the logical name: fingerprinted name mapping to a JSON manifest file (can\'t be used with --overwrite)')
+	parser.add_option('--fingerprint-templates', action = 'store_true', default = False, dest = 'fingerprint_templates', help = 'rewrite the href / src references in the templates with inline code to the fingerprinted names (requires --fingerprint) [default: %default]')
+	
+	parser.add_option('--index-file', action = 'store', type = 'string', dest = 'index_file', metavar = 'INDEX_FILE', help = 'save the index of the asset files to a file and reuse it on the next run (unchanged directories are not listed again)')
+	
+	parser.add_option('--no-git', action = 'store_false', default = True, dest = 'git', help = 'don\'t compare the git blob IDs of the files (used with --skip-not-modified when the assets path is inside a git work tree) instead of their modification times')
+	parser.add_option('--save-state', action = 'store', type = 'string', dest = 'save_state', metavar = 'STATE_FILE', help = 'save the state (size, modification time, content hash and tool version) of the files which were worked on during this run to a SQLite database')
 	parser.add_option('--skip-not-modified', action = 'store', type = 'string', dest = 'skip_not_modified', metavar = 'STATE_FILE', help = 'skip the files located in the provided state file which weren\'t modified since the last run')
 	
 	parser.add_option('--path', action = 'store', type = 'string', dest = 'assets_path', metavar = 'PATH', help = 'path to your asset files')
@@ -544,11 +3649,47 @@ if __name__ == '__main__':
 	parser.add_option('--minify-inline-css', action = 'store_true', default = False, dest = 'action_minify_inline_css', help = 'find and minify blocks of CSS in your templates')
 	parser.add_option('--compile-js', action = 'store_true', default = False, dest = 'action_compile_js', help = 'compile JavaScript files using Google Closure Compiler')
 	parser.add_option('--compile-inline-js', action = 'store_true', default = False, dest = 'action_compile_inline_js', help = 'find and compile blocks of JavaScript in your templates using Google Closure Compiler')
+	parser.add_option('--bundles', action = 'store', type = 'string', dest = 'bundles_manifest', metavar = 'MANIFEST', help = 'build the JavaScript / CSS bundles described in the JSON manifest file (bundle file name: list of input files or glob patterns)')
 	parser.add_option('--compress-images', action = 'store_true', default = False, dest = 'action_compress_imgs', help = 'compress image files')
 	
+	parser.add_option('--benchmark', action = 'store', type = 'string', dest = 'benchmark', metavar = 'RESULTS_FILE', help = 'run the benchmark on a synthetic asset corpus with stub tools (no Java needed) and save the results as JSON (- for standard output)')
+	parser.add_option('--benchmark-files', action = 'store', type = 'string', default = '200,200,100,100', dest = 'benchmark_files', metavar = 'CSS,JS,TEMPLATES,IMAGES', help = 'number of the generated files of each type [default: %default]')
+	parser.add_option('--benchmark-inline-blocks', action = 'store', type = 'int', default = 4, dest = 'benchmark_inline_blocks', metavar = 'N', help = 'number of inline CSS / JavaScript blocks in every generated template [default: %default]')
+	parser.add_option('--benchmark-latency', action = 'store', type = 'float', default = 0.05, dest = 'benchmark_latency', metavar = 'SECONDS', help = 'how long every stub tool run takes [default: %default]')
+	parser.add_option('--benchmark-runs', action = 'store', type = 'int', default = 3, dest = 'benchmark_runs', metavar = 'N', help = 'number of the benchmark runs, the median times are reported [default: %default]')
+	
 	(options, args) = parser.parse_args()
 	options = vars(options)
+	
+	if options['benchmark']:
+		logging.basicConfig(level = logging.INFO if options['verbose'] else logging.ERROR, format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt = '%d.%m.%Y %H:%M:%S')
+		
+		try:
+			(css_count, js_count, template_count, image_count) = [int(count) for count in options['benchmark_files'].split(',')]
+		except ValueError:
+			parser.error('--benchmark-files must be four comma separated numbers')
+		
+		benchmark = Benchmark(css_count, js_count, template_count, image_count, options['benchmark_inline_blocks'], options['benchmark_latency'], \
+							options['benchmark_runs'], jobs = options['jobs'], python_css_threshold = options['python_css_threshold'])
+		results = json.dumps(benchmark.run(), indent = 4, sort_keys = True)
+		
+		if options['benchmark'] == '-':
+			print results
+		else:
+			with open(options['benchmark'], 'w') as file:
+				file.write(results + '\n')
+				
+		sys.exit(0)
 
+	if options['merge_shards']:
+		if not (options['save_state'] or options['report_file'] or options['fingerprint_manifest']):
+			parser.error('--merge-shards requires --save-state, --report or --fingerprint')
+		
+		asset_deflator = AssetDeflator(options['assets_path'] or '', {}, False, options['print_statistics'], options['save_state'], \
+									report_file = options['report_file'], report_top = options['report_top'], fingerprint_manifest = options['fingerprint_manifest'])
+		asset_deflator.merge_shards(options['merge_shards'])
+		sys.exit(0)
+	
 	if not options['assets_path']:
 		parser.error('you must supply location of your assets')
 		
@@ -557,12 +3698,57 @@ if __name__ == '__main__':
 	else:
 		actions = dict([(key[key.find('_') + 1:], value) for key, value in options.iteritems() if key.find('action_') != -1 and value != False])
 	
-	if not actions:
+	if options['bundles_manifest']:
+		actions['build_bundles'] = True
+	
+	if options['fingerprint_manifest'] and options['overwrite_original']:
+		parser.error('--fingerprint can\'t be used with --overwrite')
+	
+	if options['fingerprint_templates'] and not options['fingerprint_manifest']:
+		parser.error('--fingerprint-templates requires --fingerprint')
+	
+	if options['refine'] and not (options['skip_not_modified'] and options['save_state']):
+		parser.error('--refine requires --skip-not-modified and --save-state')
+		
+	if options['refine_advanced_js'] and not options['refine']:
+		parser.error('--refine-advanced-js requires --refine')
+	
+	if options['refine'] and (options['watch'] or options['serve']):
+		parser.error('--refine can\'t be used with --watch or --serve')
+	
+	shard = None
+	if options['shard']:
+		match = re.match(r'^(\d+)/(\d+)$', options['shard'])
+		if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+			parser.error('--shard must be I/N, where 1 <= I <= N')
+		
+		if options['fingerprint_templates']:
+			parser.error('--fingerprint-templates can\'t be used with --shard (templates need the fingerprints of all the shards)')
+			
+		shard = (int(match.group(1)), int(match.group(2)))
+	
+	if not actions and not options['serve']:
 		parser.error('you must supply at least one action')
 	
 	# Set up logging	
 	logging.basicConfig(level = logging.INFO if options['verbose'] else logging.ERROR, format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt = '%d.%m.%Y %H:%M:%S')
 
 	asset_deflator = AssetDeflator(options['assets_path'], actions, options['overwrite_original'], options['print_statistics'], \
-								options['save_state'], options['skip_not_modified'])
-	asset_deflator.start()
\ No newline at end of file
+								options['save_state'], options['skip_not_modified'], java_workers = options['java_workers'], jobs = options['jobs'], \
+								cache_directory = options['cache_directory'], cache_size = options['cache_size'] * 1024 * 1024, \
+								cache_hard_link = options['cache_hard_link'], index_file = options['index_file'], \
+								jpeg_max_quality = options['jpeg_max_quality'], png_level = options['png_level'], gif_level = options['gif_level'], \
+								precompress = options['precompress'], bundles_manifest = options['bundles_manifest'], \
+								python_css_threshold = options['python_css_threshold'], report_file = options['report_file'], \
+								report_top = options['report_top'], profile_file = options['profile_file'], \
+								fingerprint_manifest = options['fingerprint_manifest'], fingerprint_templates = options['fingerprint_templates'], \
+								shard = shard, memory_budget = options['memory_budget'] * 1024 * 1024 if options['memory_budget'] else None, \
+								java_heap_size = options['java_heap_size'], refine = options['refine'], refine_advanced_js = options['refine_advanced_js'], \
+								min_savings = options['min_savings'], git = options['git'])
+	
+	if options['serve']:
+		asset_deflator.serve(options['serve'], options['serve_cache_size'] * 1024 * 1024)
+	elif options['watch']:
+		asset_deflator.watch(options['watch_interval'], options['watch_debounce'])
+	else:
+		asset_deflator.start()
\ No newline at end of file
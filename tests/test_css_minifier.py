@@ -0,0 +1,62 @@
+"""
+Golden file check of the Python CSS minifier: each tests/css/NAME.css must minify to tests/css/NAME.min.css.
+
+The expected outputs are the YUI compressor outputs (checked against YUI compressor itself if Java and the YUI
+compressor jar are installed), except for the cases in YUI_DIFFERENCES where the Python minifier deliberately
+differs.
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asset_deflator import PythonCSSMinifier, JAVA_PATH, YUI_COMPRESSOR_PATH, YUI_COMPRESSOR_CSS_ARGS
+
+CSS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'css')
+
+YUI_DIFFERENCES = {
+	'combinators.css': 'YUI compressor keeps the whitespace around ~ and the ^= $= *= |= attribute operators',
+	'preserved_comment_empty_rule.css': 'YUI compressor drops the /*! */ comment together with the empty rule which follows it',
+	'stray_brace.css': 'YUI compressor keeps the stray }'
+}
+
+class PythonCSSMinifierTest(unittest.TestCase):
+	
+	def test_golden_files(self):
+		minifier = PythonCSSMinifier()
+		
+		for (name, css, expected) in self.__get_golden_files():
+			self.assertEqual(minifier.minify(css), expected, name)
+			
+	@unittest.skipUnless(os.path.exists(JAVA_PATH) and os.path.exists(YUI_COMPRESSOR_PATH), 'Java or YUI compressor is not installed')
+	def test_yui_compressor_outputs(self):
+		for (name, css, expected) in self.__get_golden_files():
+			if name in YUI_DIFFERENCES:
+				continue
+			
+			process = subprocess.Popen([JAVA_PATH, '-jar', YUI_COMPRESSOR_PATH] + YUI_COMPRESSOR_CSS_ARGS + [os.path.join(CSS_PATH, name)], \
+									stdout = subprocess.PIPE)
+			self.assertEqual(process.communicate()[0], expected, name)
+			
+	def __get_golden_files(self):
+		""" Return the (name, CSS, expected output) tuples of the golden files. """
+		
+		files = []
+		for name in sorted(os.listdir(CSS_PATH)):
+			if not name.endswith('.css') or name.endswith('.min.css'):
+				continue
+			
+			with open(os.path.join(CSS_PATH, name)) as f:
+				css = f.read()
+			with open(os.path.join(CSS_PATH, name[:-4] + '.min.css')) as f:
+				expected = f.read()
+				
+			files.append((name, css, expected))
+			
+		return files
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,67 @@
+""" State file handling of the files whose tool failed """
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asset_deflator import AssetDeflator, MinifierEngine, ToolError
+
+class TestEngine(MinifierEngine):
+	""" Collapses the whitespace, or fails like an external tool if failing is set. """
+	
+	tool = 'test'
+	version = '1'
+	failing = False
+	
+	def minify(self, code):
+		if self.failing:
+			raise ToolError(self.tool, 1)
+		
+		return ' '.join(code.split())
+
+class FailedToolTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.directory = tempfile.mkdtemp(prefix = 'asset_deflator_test_')
+		self.assets_path = os.path.join(self.directory, 'assets')
+		self.state_file = os.path.join(self.directory, 'state.db')
+		self.engine = TestEngine()
+		os.mkdir(self.assets_path)
+		
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+		
+	def test_failed_file_is_worked_on_again(self):
+		self.__write('a.js', 'var  v1;')
+		self.__run()
+		self.assertEqual(self.__read('a.min.js'), 'var v1;')
+		
+		self.__write('a.js', 'var  v2;')
+		self.engine.failing = True
+		self.__run()
+		self.assertEqual(self.__read('a.min.js'), 'var v1;')
+		
+		self.engine.failing = False
+		self.__run()
+		self.assertEqual(self.__read('a.min.js'), 'var v2;')
+		
+	def __run(self):
+		asset_deflator = AssetDeflator(self.assets_path, {'compile_js': True}, False, False, self.state_file, self.state_file, \
+									lock_file = os.path.join(self.directory, 'test.lock'), java_workers = 0, jobs = 1, git = False)
+		asset_deflator.register_engine('js', self.engine)
+		asset_deflator.start()
+		
+	def __write(self, name, content):
+		with open(os.path.join(self.assets_path, name), 'wb') as file:
+			file.write(content)
+			
+	def __read(self, name):
+		with open(os.path.join(self.assets_path, name), 'rb') as file:
+			return file.read()
+
+if __name__ == '__main__':
+	unittest.main()